@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import asyncio
+import argparse
+import json
+import os
+import time
+
+from rcon import RCONMessage
+from minecraft_config import MinecraftConfig
+
+class FakeRCONServer:
+    # Answers the RCON protocol the way a Minecraft server does: auth replies
+    # with the request id (or -1 on a bad password), commands reply with type
+    # 0 packets of at most fragment_size bytes, and any other request type
+    # gets a single "Unknown request" packet. Each connection answers its
+    # requests in order, latency seconds apart, like the server's per-client
+    # RCON thread waiting on the main thread.
+    #
+    # With strict, each read must also be exactly one packet, as vanilla's
+    # RconClient takes one read() of up to READ_SIZE bytes per packet. A read
+    # with anything more (or less) closes the connection, as extra bytes
+    # end up doing there, so clients that pipeline show up as errors.
+    READ_SIZE = 1460
+    # Where the fake JVM keeps its count of dropped connections, in the
+    # world it runs in, for whoever started it to read.
+    STATS_FILENAME = "fake_server.json"
+
+    def __init__(self, password, *, latency=0.0, fragment_size=4096, reply_size=64, strict=False, on_drop=None):
+        self._password = password
+        self._latency = latency
+        self._fragment_size = fragment_size
+        self._reply_size = reply_size
+        self._strict = strict
+        self._on_drop = on_drop
+        self._server = None
+        self.port = None
+        self.stopped = asyncio.Event()
+        self.commands = 0
+        self.dropped = 0
+
+    def reply(self, command):
+        name = command.split(' ', 1)[0]
+        if name == 'stop':
+            asyncio.get_running_loop().call_later(0.1, self.stopped.set)
+            return 'Stopping the server'
+        if name == 'say':
+            return ''
+        if name == 'list':
+            return 'There are 0 of a max of 20 players online: '
+        # Anything else gets reply_size bytes, to exercise fragmentation.
+        return (command + ' ' + '.' * self._reply_size)[:self._reply_size]
+
+    async def _answer(self, writer, msg):
+        if msg.type == 3:
+            request_id = msg.request_id if msg.payload == self._password.encode('utf-8') else 0xffffffff
+            writer.write(RCONMessage(2, b'', request_id).encode())
+        elif msg.type == 2:
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            self.commands += 1
+            payload = self.reply(msg.payload.decode('utf-8')).encode('utf-8')
+            for i in range(0, max(len(payload), 1), self._fragment_size):
+                writer.write(RCONMessage(0, payload[i:i + self._fragment_size], msg.request_id).encode())
+        else:
+            writer.write(RCONMessage(0, 'Unknown request {:x}'.format(msg.type).encode('utf-8'), msg.request_id).encode())
+        await writer.drain()
+
+    async def _read_packet(self, reader):
+        if not self._strict:
+            raw_data = await reader.readexactly(RCONMessage.SIZE.size)
+            return raw_data + await reader.readexactly(RCONMessage.SIZE.unpack(raw_data)[0])
+        raw_data = await reader.read(self.READ_SIZE)
+        if not raw_data:
+            raise ConnectionError('Connection closed')
+        if len(raw_data) < RCONMessage.SIZE.size or len(raw_data) != RCONMessage.SIZE.size + RCONMessage.SIZE.unpack_from(raw_data)[0]:
+            self.dropped += 1
+            if self._on_drop is not None:
+                self._on_drop(self)
+            raise ConnectionError('Read of {} bytes is not one packet'.format(len(raw_data)))
+        return raw_data
+
+    async def _connection_handler(self, reader, writer):
+        try:
+            while True:
+                await self._answer(writer, RCONMessage(await self._read_packet(reader)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        # Returns the port, which is picked by the OS when port is 0.
+        self._server = await asyncio.start_server(self._connection_handler, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+def write_stats(server):
+    with open(FakeRCONServer.STATS_FILENAME, 'w') as f:
+        json.dump({'dropped': server.dropped}, f)
+
+def read_stats(world):
+    try:
+        with open(os.path.join(world, FakeRCONServer.STATS_FILENAME), 'r') as f:
+            return json.load(f)
+    except OSError:
+        return {'dropped': 0}
+
+def console(message):
+    print('[{} INFO]: {}'.format(time.strftime('%H:%M:%S'), message), flush=True)
+
+async def fake_jvm(args):
+    # Stands in for "java ... -jar server.jar" under MinecraftProcess: serves
+    # RCON on the port and password in ./server.properties and prints the
+    # console lines MinecraftProcess waits for.
+    config = MinecraftConfig(os.getcwd())
+    start_time = time.monotonic()
+    console('Starting minecraft server version fake')
+    server = FakeRCONServer(config['rcon.password'], latency=args.latency, fragment_size=args.fragment_size, reply_size=args.reply_size,
+                            strict=args.strict, on_drop=write_stats)
+    port = await server.start(port=int(config['rcon.port']))
+    console('RCON running on 0.0.0.0:{}'.format(port))
+    console('Done ({:.3f}s)! For help, type "help"'.format(time.monotonic() - start_time))
+    await server.stopped.wait()
+    await server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each command is answered")
+    parser.add_argument("--fragment-size", type=int, default=4096, help="Largest reply packet payload")
+    parser.add_argument("--reply-size", type=int, default=64, help="Bytes in the reply to commands other than say, list and stop")
+    parser.add_argument("--strict", action="store_true", help="Close connections that send anything but one packet per read, like vanilla")
+    # Everything else is the JVM command line, which is ignored.
+    args, jvm_args = parser.parse_known_args()
+    asyncio.run(fake_jvm(args))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import asyncio
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from rcon import RCON, MinecraftRCON
+from minecraft_process import MinecraftProcess
+from minecraft_manage import MinecraftSocketServer
+from minecraft_client import MinecraftClient
+from minecraft_stats import percentile
+from benchmarks.fake_server import FakeRCONServer, read_stats
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+PASSWORD = "benchmark"
+SCENARIOS = ('rcon', 'minecraft_rcon', 'process', 'socket')
+
+async def drive(call, clients, requests, warmup):
+    # clients concurrent loops, each awaiting call() requests times in a row.
+    # call() returns whether the request succeeded. Returns (seconds, latencies
+    # of the successful requests, errors).
+    for i in range(warmup):
+        await call()
+    latencies = []
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        for i in range(requests):
+            start_time = time.perf_counter()
+            try:
+                success = await call()
+            except Exception:
+                success = False
+            if success:
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                errors += 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(clients)])
+    return time.perf_counter() - start_time, latencies, errors
+
+@contextlib.asynccontextmanager
+async def fake_server(args):
+    server = FakeRCONServer(PASSWORD, latency=args.latency, fragment_size=args.fragment_size, reply_size=args.reply_size, strict=args.strict)
+    await server.start()
+    try:
+        yield server
+    finally:
+        await server.close()
+
+def fake_world(path, args):
+    # A world directory, a placeholder jar and a "java" that runs the fake
+    # server instead, for MinecraftProcess to start.
+    world = os.path.join(path, "world")
+    os.makedirs(world)
+    jar = os.path.join(path, "server.jar")
+    open(jar, 'wb').close()
+    java = os.path.join(path, "java")
+    fake_args = ['--latency', str(args.latency), '--fragment-size', str(args.fragment_size), '--reply-size', str(args.reply_size)]
+    if args.strict:
+        fake_args.append('--strict')
+    with open(java, 'w') as f:
+        f.write("#!/bin/sh\nPYTHONPATH={} exec {} -m benchmarks.fake_server {} \"$@\"\n".format(
+            shlex.quote(REPO_PATH), shlex.quote(sys.executable), ' '.join(fake_args)))
+    os.chmod(java, 0o755)
+    return world, jar, java
+
+@contextlib.asynccontextmanager
+async def connected(rcon):
+    await rcon.connect()
+    try:
+        yield rcon
+    finally:
+        await rcon.close()
+
+async def bench_rcon(args):
+    # Raw RCON round trips, every client sharing one connection, which
+    # carries one request at a time. Each benchmark returns drive()'s
+    # results plus the connections the fake server dropped.
+    async with fake_server(args) as server, connected(RCON('127.0.0.1', server.port)) as rcon:
+        await rcon.send_and_recv(3, PASSWORD.encode('utf-8'))
+        payload = args.command.encode('utf-8')
+
+        async def call():
+            await rcon.send_and_recv(2, payload)
+            return True
+        return (*await drive(call, args.clients, args.requests, args.warmup), server.dropped)
+
+async def bench_minecraft_rcon(args):
+    # Commands with multi-packet replies reassembled, as MinecraftProcess
+    # sends them.
+    async with fake_server(args) as server, connected(MinecraftRCON('127.0.0.1', server.port)) as rcon:
+        await rcon.send_password(PASSWORD)
+        cmd = args.command.split(' ')
+
+        async def call():
+            await rcon.send_command(*cmd, multipacket=True)
+            return True
+        return (*await drive(call, args.clients, args.requests, args.warmup), server.dropped)
+
+async def bench_process(args):
+    # MinecraftProcess methods against the fake server in place of the JVM.
+    with tempfile.TemporaryDirectory() as path:
+        world, jar, java = fake_world(path, args)
+        mc_process = MinecraftProcess(jar, world, java_exe=java, stats_interval=0)
+        success, *detail = await mc_process.start()
+        if not success:
+            raise RuntimeError("Fake server didn't start: {}".format(detail))
+        try:
+            async def call():
+                return (await mc_process.say('benchmark'))[0]
+            result = await drive(call, args.clients, args.requests, args.warmup)
+        finally:
+            await mc_process.stop()
+        return (*result, read_stats(world)['dropped'])
+
+async def bench_socket(args):
+    # The whole stack: one minecraft_manage.py connection per client.
+    with tempfile.TemporaryDirectory() as path:
+        world, jar, java = fake_world(path, args)
+        socket = os.path.join(path, "manage.sock")
+        server = MinecraftSocketServer(asyncio.get_running_loop())
+        server_task = asyncio.ensure_future(server.start(socket, {'default': (world, None)}, jar, java_exe=java, stats_interval=0))
+        while not os.path.exists(socket):
+            if server_task.done():
+                server_task.result()
+                raise RuntimeError("Socket server exited before listening.")
+            await asyncio.sleep(0.05)
+        clients = [MinecraftClient(socket) for i in range(args.clients)]
+        try:
+            await asyncio.gather(*[x.connect() for x in clients])
+            idle = asyncio.Queue()
+            for client in clients:
+                idle.put_nowait(client)
+
+            async def call():
+                # Each concurrent caller holds a connection of its own.
+                client = await idle.get()
+                try:
+                    result = await client.call('say', 'benchmark')
+                finally:
+                    idle.put_nowait(client)
+                return result[0] and result[1]
+            result = await drive(call, args.clients, args.requests, args.warmup)
+        finally:
+            await asyncio.gather(*[x.close() for x in clients], return_exceptions=True)
+            await server.teardown()
+            await server_task
+        return (*result, read_stats(world)['dropped'])
+
+BENCHMARKS = {
+    'rcon': bench_rcon,
+    'minecraft_rcon': bench_minecraft_rcon,
+    'process': bench_process,
+    'socket': bench_socket,
+    }
+
+async def run_scenario(scenario, args):
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        seconds, latencies, errors, dropped = await BENCHMARKS[scenario](args)
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+    latencies.sort()
+    result = {
+        'scenario': scenario,
+        'requests': args.clients * args.requests,
+        'errors': errors,
+        # Connections the fake server closed for breaking one packet per
+        # read. Only --strict checks.
+        'dropped': dropped,
+        'seconds': round(seconds, 6),
+        'requests_per_second': round(len(latencies) / seconds, 3) if seconds else None,
+        'latency_ms': {name: round(value * 1000, 3) for name, value in (
+            ('p50', percentile(latencies, 50)), ('p99', percentile(latencies, 99)), ('max', latencies[-1]),
+            )} if latencies else None,
+        # Peak RSS of this process so far, so it only grows from one
+        # scenario to the next. Linux reports KiB.
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    if traced_peak is not None:
+        result['traced_peak_bytes'] = traced_peak
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args):
+    results = []
+    for scenario in args.scenarios:
+        print('Running {}...'.format(scenario), file=sys.stderr)
+        results.append(await run_scenario(scenario, args))
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {x: getattr(args, x) for x in ('clients', 'requests', 'warmup', 'command', 'latency', 'fragment_size', 'reply_size',
+                                                   'strict', 'trace_memory')},
+        'results': results,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m benchmarks", description="Load test the management stack against a fake server.")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="Any of {} (default all)".format(', '.join(SCENARIOS)))
+    parser.add_argument("--clients", "-c", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--requests", "-n", type=int, default=500, help="Requests per client")
+    parser.add_argument("--warmup", type=int, default=50, help="Untimed requests before each run")
+    parser.add_argument("--command", default="help", help="Command for the rcon and minecraft_rcon runs; process and socket always say")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake server takes to answer each command")
+    parser.add_argument("--fragment-size", type=int, default=4096, help="Largest reply packet the fake server sends")
+    parser.add_argument("--reply-size", type=int, default=64, help="Bytes in the fake server's reply to most commands")
+    parser.add_argument("--strict", action="store_true", help="Make the fake server take one packet per read and drop connections that send more, like vanilla")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report Python's peak allocation per run (slows it down)")
+    parser.add_argument("--output", "-o", help="Write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("{} is not one of {}".format(scenario, ', '.join(SCENARIOS)))
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    report = asyncio.run(run(args))
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    dropped = [x['scenario'] for x in report['results'] if x['dropped']]
+    if args.strict and dropped:
+        # A vanilla server would have dropped these clients too.
+        print('The fake server dropped connections in: {}'.format(', '.join(dropped)), file=sys.stderr)
+        sys.exit(1)
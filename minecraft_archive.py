@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import os
+import sys
+import io
+import bz2
+import gzip
+import lzma
+import json
+import bisect
+import tarfile
+import collections
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every codec here allows a file to be several independently compressed
+# streams back to back, so blocks of the tar stream can be compressed in
+# parallel and the result is still a plain .tar.<ext> that tar can read.
+CODECS = {
+    'gzip': ('gz', 6),
+    'bz2': ('bz2', 9),
+    'xz': ('xz', 6),
+    'zstd': ('zst', 3),
+}
+
+def compress_block(codec, level, data):
+    if codec == 'gzip':
+        return gzip.compress(data, level, mtime=0)
+    if codec == 'bz2':
+        return bz2.compress(data, level)
+    if codec == 'xz':
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+def decompress_block(codec, data):
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'bz2':
+        return bz2.decompress(data)
+    if codec == 'xz':
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    return zstandard.ZstdDecompressor().decompress(data)
+
+class ParallelArchiveWriter(io.RawIOBase):
+    class ParallelArchiveError(Exception): pass
+
+    BLOCK_SIZE = 4 << 20
+
+    def __init__(self, f, *, codec='gzip', level=None, workers=None, block_size=BLOCK_SIZE):
+        super().__init__()
+        if codec not in CODECS:
+            raise self.__class__.ParallelArchiveError("Unknown codec {}.".format(codec))
+        if codec == 'zstd' and zstandard is None:
+            raise self.__class__.ParallelArchiveError("The zstd codec needs the zstandard package.")
+        self._f = f
+        self._codec = codec
+        self._level = CODECS[codec][1] if level is None else level
+        self._workers = workers or os.cpu_count() or 1
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._in_flight = collections.deque()
+        self._pool = concurrent.futures.ProcessPoolExecutor(self._workers) if self._workers > 1 else None
+        self._uncompressed_offset = 0
+        self._compressed_offset = 0
+        # [compressed offset, uncompressed offset] of every block, for seeking.
+        self.blocks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        if self._pool is None:
+            self._write_block(len(block), compress_block(self._codec, self._level, block))
+            return
+        self._in_flight.append((len(block), self._pool.submit(compress_block, self._codec, self._level, block)))
+        # Keep every worker busy without queueing up the whole world in memory.
+        while len(self._in_flight) > self._workers * 2:
+            self._drain_one()
+
+    def _drain_one(self):
+        size, future = self._in_flight.popleft()
+        self._write_block(size, future.result())
+
+    def _write_block(self, size, compressed):
+        self.blocks.append([self._compressed_offset, self._uncompressed_offset])
+        self._f.write(compressed)
+        self._compressed_offset += len(compressed)
+        self._uncompressed_offset += size
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._in_flight:
+                self._drain_one()
+            if self._pool is not None:
+                self._pool.shutdown()
+        super().close()
+
+def create_archive(filename, root, folders, *, codec='gzip', level=None, workers=None):
+    stats = {'archive': filename, 'codec': codec, 'files': 0, 'bytes_read': 0}
+    members = {}
+    with open(filename + ".tmp", 'wb') as f:
+        writer = ParallelArchiveWriter(f, codec=codec, level=level, workers=workers)
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for folder in folders:
+                for dirpath, dirnames, filenames in os.walk(os.path.join(root, folder)):
+                    dirnames.sort()
+                    tar.add(dirpath, arcname=os.path.relpath(dirpath, root), recursive=False)
+                    for name in sorted(filenames):
+                        full_path = os.path.join(dirpath, name)
+                        arcname = os.path.relpath(full_path, root)
+                        members[arcname] = [tar.offset, os.path.getsize(full_path)]
+                        tar.add(full_path, arcname=arcname, recursive=False)
+                        stats['files'] += 1
+                        stats['bytes_read'] += members[arcname][1]
+        writer.close()
+        stats['bytes_written'] = f.tell()
+    index = {'codec': codec, 'blocks': writer.blocks, 'members': members}
+    with open(filename + ".idx.json", 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(filename + ".tmp", filename)
+    stats['blocks'] = len(writer.blocks)
+    return stats
+
+def read_member(filename, name):
+    # Pulls one file out of an archive by decompressing only the blocks that
+    # hold it, using the index written next to the archive.
+    with open(filename + ".idx.json", 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    header_offset, size = index['members'][name]
+    blocks = index['blocks']
+    uncompressed_offsets = [x[1] for x in blocks]
+    first = bisect.bisect_right(uncompressed_offsets, header_offset) - 1
+    data = bytearray()
+    with open(filename, 'rb') as f:
+        for i in range(first, len(blocks)):
+            start = blocks[i][0]
+            end = blocks[i + 1][0] if i + 1 < len(blocks) else None
+            f.seek(start)
+            data += decompress_block(index['codec'], f.read(-1 if end is None else end - start))
+            if blocks[first][1] + len(data) >= header_offset + tarfile.BLOCKSIZE * 8 + size:
+                break
+    # The member's own header tells us where its data starts (PAX headers
+    # included), so let tarfile parse from there.
+    with tarfile.open(fileobj=io.BytesIO(bytes(data[header_offset - blocks[first][1]:])), mode='r:') as tar:
+        return tar.extractfile(tar.next()).read()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--codec", "-c", choices=sorted(CODECS), default='gzip', help="Compression codec.")
+    parser.add_argument("--level", "-l", type=int, default=None, help="Compression level. (Default depends on codec.)")
+    parser.add_argument("--workers", "-j", type=int, default=None, help="Compression processes. (Default: one per core)")
+    parser.add_argument("--root", "-r", type=os.path.realpath, default=os.getcwd(), help="Directory the folders are relative to.")
+    parser.add_argument("--output", "-o", type=os.path.realpath, required=True, help="Archive to write.")
+    parser.add_argument("folders", nargs="+", help="Folders to archive.")
+    args = parser.parse_args()
+
+    json.dump(create_archive(args.output, args.root, args.folders, codec=args.codec, level=args.level, workers=args.workers), sys.stdout)
+    print()
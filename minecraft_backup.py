@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import zlib
+import fcntl
+import shutil
+import struct
+import hashlib
+import datetime
+
+from minecraft_region import RegionFile
+
+# ioctl that makes dst share src's extents on filesystems that support it
+# (btrfs, xfs, ...), so a "copy" costs next to no I/O.
+FICLONE = 0x40049409
+
+def _clone_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return False
+
+def sync_tree(root, folders, dest):
+    # Makes dest/<folder> a point-in-time copy of root/<folder>, reusing the
+    # copy left by the previous call so only files whose size or mtime changed
+    # are copied again. Hardlinks would be cheaper still, but the server
+    # rewrites region files in place, which would change the copy too.
+    stats = {'files': 0, 'files_copied': 0, 'files_cloned': 0, 'bytes_copied': 0, 'files_removed': 0}
+    os.makedirs(dest, exist_ok=True)
+    for name in os.listdir(dest):
+        if name not in folders:
+            shutil.rmtree(os.path.join(dest, name))
+    for folder in folders:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, folder)):
+            dest_dir = os.path.join(dest, os.path.relpath(dirpath, root))
+            os.makedirs(dest_dir, exist_ok=True)
+            wanted = set(dirnames) | set(filenames)
+            for name in os.listdir(dest_dir):
+                if name not in wanted:
+                    stale = os.path.join(dest_dir, name)
+                    if os.path.isdir(stale) and not os.path.islink(stale):
+                        shutil.rmtree(stale)
+                    else:
+                        os.unlink(stale)
+                    stats['files_removed'] += 1
+            for filename in filenames:
+                src = os.path.join(dirpath, filename)
+                dst = os.path.join(dest_dir, filename)
+                src_st = os.stat(src)
+                stats['files'] += 1
+                try:
+                    dst_st = os.stat(dst)
+                    if dst_st.st_size == src_st.st_size and dst_st.st_mtime_ns == src_st.st_mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+                if _clone_file(src, dst):
+                    stats['files_cloned'] += 1
+                else:
+                    stats['bytes_copied'] += src_st.st_size
+                shutil.copystat(src, dst)
+                stats['files_copied'] += 1
+    return stats
+
+class RegionDelta:
+    # One version of a region file: all 1024 timestamps, plus the data of
+    # the chunks that changed since the parent version. lengths gives each
+    # chunk's length in the payload (which is those chunks back to back, so
+    # the offsets follow), or ABSENT, or INHERITED for one that's unchanged
+    # and found by following parents. A version with no parent holds every
+    # chunk itself.
+    MAGIC = b'MCRD'
+    # magic, parent digest (zeros for none), depth, timestamps, lengths
+    HEADER = struct.Struct(">4s32sI1024I1024I")
+    ABSENT = 0
+    INHERITED = 0xffffffff
+
+    def __init__(self, parent, depth, timestamps, lengths, payload=b''):
+        self.parent = parent
+        self.depth = depth
+        self.timestamps = list(timestamps)
+        self.lengths = list(lengths)
+        self.payload = payload
+
+    @classmethod
+    def decode(cls, data, header_only=False):
+        if len(data) < cls.HEADER.size:
+            raise ChunkStore.ChunkStoreError("Region version is truncated.")
+        magic, parent, depth, *values = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ChunkStore.ChunkStoreError("Not a region version.")
+        return cls(parent.hex() if any(parent) else None, depth, values[:1024], values[1024:],
+                   b'' if header_only else data[cls.HEADER.size:])
+
+    def encode(self):
+        parent = bytes.fromhex(self.parent) if self.parent is not None else bytes(32)
+        return self.HEADER.pack(self.MAGIC, parent, self.depth, *self.timestamps, *self.lengths) + self.payload
+
+    def chunks(self):
+        # (index, data) for every chunk held in this version itself.
+        offset = 0
+        for index, length in enumerate(self.lengths):
+            if length not in (self.ABSENT, self.INHERITED):
+                yield index, self.payload[offset:offset + length]
+                offset += length
+
+class ChunkStore:
+    class ChunkStoreError(Exception): pass
+
+    CHUNK_SIZE = 1 << 20
+    # Region versions chain back at most this far before one is written in
+    # full, which bounds the reads a restore needs and lets gc free old data.
+    MAX_REGION_DEPTH = 16
+
+    def __init__(self, store_path, *, chunk_size=CHUNK_SIZE, compress_level=6):
+        self._store_path = os.path.realpath(store_path)
+        self._chunk_path = os.path.join(self._store_path, "chunks")
+        self._region_path = os.path.join(self._store_path, "regions")
+        self._manifest_path = os.path.join(self._store_path, "manifests")
+        self._chunk_size = chunk_size
+        self._compress_level = compress_level
+        os.makedirs(self._chunk_path, exist_ok=True)
+        os.makedirs(self._region_path, exist_ok=True)
+        os.makedirs(self._manifest_path, exist_ok=True)
+
+    def _chunk_filename(self, digest):
+        return os.path.join(self._chunk_path, digest[:2], digest)
+
+    def _region_filename(self, digest):
+        return os.path.join(self._region_path, digest[:2], digest)
+
+    def _atomic_write(self, filename, data):
+        tmp_filename = "{}.tmp{}".format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self._chunk_filename(digest))
+
+    def put_chunk(self, data, compress_level=None):
+        # Returns the digest and how many bytes actually hit the disk (0 if the
+        # store already had this chunk.)
+        digest = hashlib.sha256(data).hexdigest()
+        filename = self._chunk_filename(digest)
+        if os.path.exists(filename):
+            return digest, 0
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        compressed = zlib.compress(data, self._compress_level if compress_level is None else compress_level)
+        self._atomic_write(filename, compressed)
+        return digest, len(compressed)
+
+    def get_chunk(self, digest):
+        with open(self._chunk_filename(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise self.__class__.ChunkStoreError("Chunk {} is corrupt.".format(digest))
+        return data
+
+    def put_region(self, delta):
+        # Stored uncompressed: chunk data is compressed by the server already,
+        # and the header can then be read without reading the rest.
+        data = delta.encode()
+        digest = hashlib.sha256(data).hexdigest()
+        filename = self._region_filename(digest)
+        if os.path.exists(filename):
+            return digest, 0
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._atomic_write(filename, data)
+        return digest, len(data)
+
+    def get_region(self, digest, header_only=False):
+        with open(self._region_filename(digest), 'rb') as f:
+            data = f.read(RegionDelta.HEADER.size if header_only else -1)
+        if not header_only and hashlib.sha256(data).hexdigest() != digest:
+            raise self.__class__.ChunkStoreError("Region version {} is corrupt.".format(digest))
+        return RegionDelta.decode(data, header_only)
+
+    def _resolve_region(self, digest):
+        # Timestamps and index -> chunk data for a region version, gathered
+        # from it and as many of its parents as it takes.
+        delta = self.get_region(digest)
+        timestamps = delta.timestamps
+        pending = {i for i, length in enumerate(delta.lengths) if length != RegionDelta.ABSENT}
+        chunks = {}
+        while True:
+            for index, data in delta.chunks():
+                if index in pending:
+                    chunks[index] = data
+                    pending.discard(index)
+            if not pending:
+                return timestamps, chunks
+            if delta.parent is None:
+                raise self.__class__.ChunkStoreError("Region version {} is missing chunks.".format(digest))
+            delta = self.get_region(delta.parent)
+
+    def manifests(self):
+        return sorted(x[:-5] for x in os.listdir(self._manifest_path) if x.endswith('.json'))
+
+    def load_manifest(self, name):
+        with open(os.path.join(self._manifest_path, name + ".json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self, name, manifest):
+        self._atomic_write(os.path.join(self._manifest_path, name + ".json"), json.dumps(manifest).encode('utf-8'))
+
+    def _backup_file(self, filename, stats):
+        chunks = []
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(self._chunk_size)
+                if not data:
+                    break
+                digest, written = self.put_chunk(data)
+                chunks.append(digest)
+                stats['bytes_read'] += len(data)
+                stats['bytes_written'] += written
+                stats['chunks_written'] += bool(written)
+        return {'chunks': chunks}
+
+    def _backup_region(self, filename, old_entry, stats):
+        # Region files are stored as a new version holding only the chunks
+        # whose timestamp moved since the previous snapshot's version, which
+        # is found from its header alone. Falls back to plain chunking for
+        # anything that doesn't parse as a region file.
+        parent = old_entry.get('region') if old_entry is not None else None
+        previous = None
+        if isinstance(parent, str):
+            try:
+                previous = self.get_region(parent, header_only=True)
+            except (OSError, self.__class__.ChunkStoreError):
+                previous = None
+        if previous is None or previous.depth + 1 >= self.MAX_REGION_DEPTH:
+            previous = None
+        lengths = [RegionDelta.ABSENT] * RegionFile.CHUNK_COUNT
+        payload = []
+        try:
+            with open(filename, 'rb') as f:
+                region = RegionFile(f)
+                for index in region.present():
+                    if previous is not None and previous.lengths[index] != RegionDelta.ABSENT \
+                            and previous.timestamps[index] == region.timestamps[index]:
+                        lengths[index] = RegionDelta.INHERITED
+                        stats['region_chunks_unchanged'] += 1
+                        continue
+                    data = region.read_chunk(index)
+                    lengths[index] = len(data)
+                    payload.append(data)
+                    stats['bytes_read'] += len(data)
+                    stats['region_chunks_read'] += 1
+        except RegionFile.RegionFileError:
+            return self._backup_file(filename, stats)
+        if previous is not None and not payload and region.timestamps == previous.timestamps \
+                and all((x == RegionDelta.ABSENT) == (y == RegionDelta.ABSENT) for x, y in zip(lengths, previous.lengths)):
+            # Touched, but no chunk changed.
+            return {'chunks': [], 'region': parent}
+        delta = RegionDelta(parent if previous is not None else None, previous.depth + 1 if previous is not None else 0,
+                            region.timestamps, lengths, b''.join(payload))
+        digest, written = self.put_region(delta)
+        stats['bytes_written'] += written
+        stats['region_versions_written'] += bool(written)
+        return {'chunks': [], 'region': digest}
+
+    @staticmethod
+    def _entry_chunks(entry):
+        if isinstance(entry.get('region'), dict):
+            # Snapshots from before region versions: one store chunk per
+            # Minecraft chunk.
+            return entry['region']['chunks'].values()
+        return entry['chunks']
+
+    def backup(self, root, folders, name=None):
+        root = os.path.realpath(root)
+        if name is None:
+            name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        existing = self.manifests()
+        base_name, suffix = name, 1
+        while name in existing:
+            name = "{}-{}".format(base_name, suffix)
+            suffix += 1
+        previous = self.load_manifest(existing[-1])['files'] if existing else {}
+        manifest = {'created': datetime.datetime.now().isoformat(), 'dirs': [], 'files': {}}
+        stats = {'manifest': name, 'files': 0, 'files_unchanged': 0, 'bytes_read': 0, 'bytes_written': 0, 'chunks_written': 0,
+                 'region_chunks_read': 0, 'region_chunks_unchanged': 0, 'region_versions_written': 0}
+
+        for folder in folders:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(root, folder)):
+                dirnames.sort()
+                manifest['dirs'].append(os.path.relpath(dirpath, root))
+                for filename in sorted(filenames):
+                    full_path = os.path.join(dirpath, filename)
+                    rel_path = os.path.relpath(full_path, root)
+                    st = os.stat(full_path)
+                    entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'mode': st.st_mode & 0o7777}
+                    old_entry = previous.get(rel_path)
+                    # Same size and mtime as last time: trust the old entry
+                    # instead of reading the file again. gc never removes
+                    # anything the newest snapshot refers to.
+                    if old_entry is not None and old_entry['size'] == entry['size'] and old_entry['mtime_ns'] == entry['mtime_ns']:
+                        entry['chunks'] = old_entry['chunks']
+                        if 'region' in old_entry:
+                            entry['region'] = old_entry['region']
+                        stats['files_unchanged'] += 1
+                    elif filename.endswith('.mca'):
+                        entry.update(self._backup_region(full_path, old_entry, stats))
+                    else:
+                        entry.update(self._backup_file(full_path, stats))
+                    manifest['files'][rel_path] = entry
+                    stats['files'] += 1
+
+        self._save_manifest(name, manifest)
+        return stats
+
+    def _restore_file(self, entry, filename):
+        with open(filename, 'wb') as f:
+            if isinstance(entry.get('region'), str):
+                RegionFile.write(f, *self._resolve_region(entry['region']))
+                return
+            if 'region' in entry:
+                chunks = {int(index): self.get_chunk(digest) for index, digest in entry['region']['chunks'].items()}
+                RegionFile.write(f, entry['region']['timestamps'], chunks)
+                return
+            for digest in entry['chunks']:
+                f.write(self.get_chunk(digest))
+
+    def restore(self, name, dest):
+        manifest = self.load_manifest(name)
+        dest = os.path.realpath(dest)
+        for rel_path in manifest['dirs']:
+            os.makedirs(os.path.join(dest, rel_path), exist_ok=True)
+        for rel_path, entry in manifest['files'].items():
+            filename = os.path.join(dest, rel_path)
+            self._restore_file(entry, filename)
+            os.chmod(filename, entry['mode'])
+            os.utime(filename, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return {'manifest': name, 'files': len(manifest['files'])}
+
+    def prune(self, keep):
+        names = self.manifests()
+        removed = names[:-keep] if keep > 0 else names
+        for name in removed:
+            os.unlink(os.path.join(self._manifest_path, name + ".json"))
+        return {'removed': removed, 'kept': len(names) - len(removed)}
+
+    def _referenced_chunks(self, manifest):
+        for entry in manifest['files'].values():
+            yield from self._entry_chunks(entry)
+
+    def _referenced_regions(self, manifest, referenced):
+        # Adds every region version the manifest needs, parents included.
+        for entry in manifest['files'].values():
+            digest = entry.get('region')
+            while isinstance(digest, str) and digest not in referenced:
+                referenced.add(digest)
+                digest = self.get_region(digest, header_only=True).parent
+
+    @staticmethod
+    def _remove_unreferenced(path, referenced):
+        removed = 0
+        freed = 0
+        for prefix in os.listdir(path):
+            prefix_path = os.path.join(path, prefix)
+            for digest in os.listdir(prefix_path):
+                if digest not in referenced:
+                    filename = os.path.join(prefix_path, digest)
+                    freed += os.path.getsize(filename)
+                    os.unlink(filename)
+                    removed += 1
+        return removed, freed
+
+    def gc(self):
+        referenced = set()
+        regions = set()
+        for name in self.manifests():
+            manifest = self.load_manifest(name)
+            referenced.update(self._referenced_chunks(manifest))
+            self._referenced_regions(manifest, regions)
+        chunks_removed, chunks_freed = self._remove_unreferenced(self._chunk_path, referenced)
+        regions_removed, regions_freed = self._remove_unreferenced(self._region_path, regions)
+        return {'chunks_removed': chunks_removed, 'regions_removed': regions_removed, 'bytes_freed': chunks_freed + regions_freed,
+                'chunks_referenced': len(referenced), 'regions_referenced': len(regions)}
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", "-s", type=os.path.realpath, required=True, help="Location of the chunk store.")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    backup_parser = subparsers.add_parser('backup', help="Snapshot folders into the store.")
+    backup_parser.add_argument("--root", "-r", type=os.path.realpath, default=os.getcwd(), help="Directory the folders are relative to.")
+    backup_parser.add_argument("--keep", "-k", type=int, default=None, help="Prune to this many snapshots and collect garbage afterwards.")
+    backup_parser.add_argument("folders", nargs="+", help="Folders to back up.")
+    restore_parser = subparsers.add_parser('restore', help="Rebuild a snapshot into a directory.")
+    restore_parser.add_argument("manifest", help="Snapshot to restore.")
+    restore_parser.add_argument("dest", type=os.path.realpath, help="Directory to restore into.")
+    prune_parser = subparsers.add_parser('prune', help="Drop all but the newest snapshots.")
+    prune_parser.add_argument("keep", type=int, help="Number of snapshots to keep.")
+    subparsers.add_parser('gc', help="Delete chunks no snapshot refers to.")
+    subparsers.add_parser('list', help="List snapshots.")
+    args = parser.parse_args()
+
+    store = ChunkStore(args.store)
+    if args.action == 'backup':
+        result = store.backup(args.root, args.folders)
+        if args.keep is not None:
+            result['prune'] = store.prune(args.keep)
+            result['gc'] = store.gc()
+    elif args.action == 'restore':
+        result = store.restore(args.manifest, args.dest)
+    elif args.action == 'prune':
+        result = store.prune(args.keep)
+    elif args.action == 'gc':
+        result = store.gc()
+    else:
+        result = store.manifests()
+    json.dump(result, sys.stdout)
+    print()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import asyncio
+import collections
+import time
+
+class CommandCache:
+    # Read-through cache for read-only commands. Each entry carries tags
+    # naming what it depends on; invalidating a tag drops those entries at
+    # once. Concurrent misses on one key share a single fetch.
+    def __init__(self, ttl):
+        self._ttl = ttl
+        # key -> (expiry, result)
+        self._entries = {}
+        # key -> Future of the fetch in flight
+        self._in_flight = {}
+        self._tagged = collections.defaultdict(set)
+        # Bumped on every invalidation, so a fetch that started before one
+        # doesn't store its now-stale result afterwards.
+        self._generations = collections.Counter()
+        self.counts = collections.Counter()
+
+    async def get(self, key, fetch, tags=(), cacheable=None):
+        # fetch() is a coroutine function producing the result. cacheable
+        # (result) decides whether a result is kept; failures usually aren't.
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.counts['hit'] += 1
+            return entry[1]
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.counts['shared'] += 1
+            return await asyncio.shield(future)
+
+        self.counts['miss'] += 1
+        generations = [self._generations[x] for x in tags]
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fetch()
+        except BaseException as ex:
+            future.set_exception(ex)
+            # Nobody else may be waiting, and an unretrieved exception warns.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+        if (cacheable is None or cacheable(result)) and generations == [self._generations[x] for x in tags]:
+            self._entries[key] = (time.monotonic() + self._ttl, result)
+            for tag in tags:
+                self._tagged[tag].add(key)
+        return result
+
+    def invalidate(self, tag):
+        self._generations[tag] += 1
+        self.counts['invalidation'] += 1
+        for key in self._tagged.pop(tag, ()):
+            self._entries.pop(key, None)
+            # Later callers mustn't join a fetch that may predate the change.
+            self._in_flight.pop(key, None)
+
+    def stats(self):
+        lookups = self.counts['hit'] + self.counts['shared'] + self.counts['miss']
+        return {
+            'ttl': self._ttl,
+            'entries': len(self._entries),
+            'in_flight': len(self._in_flight),
+            'hits': self.counts['hit'],
+            'shared': self.counts['shared'],
+            'misses': self.counts['miss'],
+            'invalidations': self.counts['invalidation'],
+            'hit_ratio': round((self.counts['hit'] + self.counts['shared']) / lookups, 3) if lookups else None,
+            }
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import asyncio
+import itertools
+import struct
+import json
+
+FRAME_SIZE = struct.Struct("I")
+MAX_FRAME_SIZE = 64 << 20
+
+class MinecraftClient:
+    # Client for minecraft_manage.py's persistent socket protocol. One
+    # connection carries any number of concurrent calls; replies are matched
+    # back to their callers by id.
+    class MinecraftClientError(Exception): pass
+
+    def __init__(self, socket_path):
+        self._socket_path = socket_path
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._streams = {}
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self._socket_path, limit=MAX_FRAME_SIZE)
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_frame(self):
+        size = FRAME_SIZE.unpack(await self._reader.readexactly(FRAME_SIZE.size))[0]
+        return json.loads((await self._reader.readexactly(size)).decode('utf-8'))
+
+    def _route_frame(self, frame):
+        stream = self._streams.get(frame.get('id'))
+        if stream is not None:
+            stream.put_nowait(frame)
+            return
+        if 'event' in frame:
+            return
+        future = self._pending.pop(frame.get('id'), None)
+        if future is not None and not future.done():
+            future.set_result(frame)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._route_frame(await self._read_frame())
+        except asyncio.CancelledError:
+            error = ConnectionError("Connection closed.")
+        except Exception as ex:
+            error = ConnectionError("Connection lost: {!r}".format(ex))
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        for stream in self._streams.values():
+            stream.put_nowait(error)
+        self._streams.clear()
+        self._reader_task = None
+
+    async def _send(self, request):
+        raw = json.dumps(request).encode('utf-8')
+        self._writer.write(FRAME_SIZE.pack(len(raw)) + raw)
+        await self._writer.drain()
+
+    async def _request(self, request, timeout=None):
+        if self._reader_task is None:
+            raise ConnectionError("Not connected.")
+        request['id'] = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request['id']] = future
+        try:
+            await self._send(request)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request['id'], None)
+
+    async def call(self, method, *args, timeout=None):
+        # Returns the same [True, success, detail...] list the one-shot
+        # protocol does.
+        return (await self._request({'call': [method, *args]}, timeout))['reply']
+
+    async def batch(self, calls, *, parallel=False, timeout=None):
+        # Runs a list of [method, args...] calls in one round trip, in order
+        # unless parallel is set.
+        return (await self._request({'batch': [list(x) for x in calls], 'parallel': parallel}, timeout))['replies']
+
+    async def subscribe(self, method, *args):
+        # Async iterator over a streaming method's events. Leaving the loop
+        # cancels the stream on the server.
+        if self._reader_task is None:
+            raise ConnectionError("Not connected.")
+        request_id = next(self._ids)
+        stream = asyncio.Queue()
+        self._streams[request_id] = stream
+        finished = False
+        try:
+            await self._send({'id': request_id, 'call': [method, *args]})
+            while True:
+                frame = await stream.get()
+                if isinstance(frame, Exception):
+                    raise frame
+                if 'event' not in frame:
+                    finished = True
+                    reply = frame.get('reply')
+                    if reply is not None and not reply[0]:
+                        raise self.__class__.MinecraftClientError(reply[2])
+                    break
+                yield frame['event']
+        finally:
+            self._streams.pop(request_id, None)
+            if not finished and self._reader_task is not None:
+                await self._send({'cancel': request_id})
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self._writer.close()
+        await self._writer.wait_closed()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import asyncio
+import collections
+
+class Subscription:
+    # One live reader of a feed of dict items. Items that arrive while the
+    # queue is full are dropped rather than waited for; the first item after
+    # the gap says how many went missing.
+    def __init__(self, subscriptions, maxsize, accept=None):
+        self._subscriptions = subscriptions
+        self._queue = asyncio.Queue(maxsize)
+        self._dropped = 0
+        self._accept = accept
+        self.closed = False
+        self._subscriptions.add(self)
+
+    def offer(self, item):
+        if self._accept is not None and not self._accept(item):
+            return
+        if self._queue.full():
+            self._dropped += 1
+            return
+        if self._dropped:
+            item = dict(item, dropped=self._dropped)
+            self._dropped = 0
+        self._queue.put_nowait(item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        return await self._queue.get()
+
+    def close(self):
+        self.closed = True
+        self._subscriptions.discard(self)
+
+class ConsoleBuffer:
+    # The last max_lines lines of server output, capped at max_bytes in
+    # total, plus fan-out to live subscribers. Nothing here ever waits on a
+    # consumer, so a slow client can't back up the server's stdout pipe.
+    def __init__(self, *, max_lines=10000, max_bytes=4 << 20, max_line_length=8192):
+        self._lines = collections.deque()
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._max_line_length = max_line_length
+        self._bytes = 0
+        self._seq = 0
+        self._subscriptions = set()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        # listener(line) is called synchronously for every line, so it has to
+        # be cheap.
+        self._listeners.append(listener)
+
+    def append(self, line):
+        if len(line) > self._max_line_length:
+            line = line[:self._max_line_length] + '...'
+        self._seq += 1
+        self._lines.append((self._seq, line))
+        self._bytes += len(line)
+        while len(self._lines) > self._max_lines or self._bytes > self._max_bytes:
+            self._bytes -= len(self._lines.popleft()[1])
+        if self._subscriptions:
+            item = {'seq': self._seq, 'line': line}
+            for subscription in self._subscriptions:
+                subscription.offer(item)
+        for listener in self._listeners:
+            listener(line)
+
+    def tail(self, count):
+        count = max(0, min(int(count), len(self._lines)))
+        return [{'seq': seq, 'line': line} for seq, line in list(self._lines)[len(self._lines) - count:]]
+
+    def subscribe(self, maxsize=1000):
+        return Subscription(self._subscriptions, maxsize)
+
+    async def read_stream(self, reader):
+        while True:
+            try:
+                raw = await reader.readline()
+            except ValueError:
+                # Longer than the reader's limit. The line's been discarded.
+                self.append('[line too long]')
+                continue
+            if not raw:
+                break
+            self.append(raw.decode('utf-8', 'replace').rstrip('\r\n'))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import re
+import collections
+
+from minecraft_console import Subscription
+
+# "[12:34:56 INFO]: message" (Spigot/Paper console) or
+# "[12:34:56] [Server thread/INFO]: message" (vanilla).
+LINE_RE = re.compile(r'^\[(?P<time>\d\d:\d\d:\d\d)(?: (?P<level>[A-Z]+))?\](?: \[[^\]]*/(?P<thread_level>[A-Z]+)\])?: (?P<message>.*)$')
+
+DEATH_CAUSES = (
+    r'was (?:slain|shot|killed|pummeled|blown up|fireballed|squashed|squished|impaled|stung|poked|pricked|skewered|obliterated|doomed|roasted|'
+    r'burnt|incinerated|frozen|struck by lightning|knocked into the void|pushed)',
+    r'drowned', r'died', r'blew up', r'hit the ground too hard', r'fell', r'tried to swim in lava', r'burned to death', r'went up in flames',
+    r'walked into', r'experienced kinetic energy', r'starved to death', r'suffocated', r'withered away', r'froze to death',
+    r'discovered the floor was lava', r'went off with a bang', r"didn't want to live", r'left the confines of this world',
+    )
+
+# One alternative per event type, tried in order at the start of the message
+# by a single compiled regex. The outer group names the event; inner groups
+# named <type>_<field> become the event's fields.
+EVENT_PATTERNS = (
+    ('started', r'Done \((?P<started_seconds>[\d.]+)s\)!'),
+    ('rcon_ready', r'RCON running on (?P<rcon_ready_address>\S+)'),
+    ('join', r'(?P<join_player>\w+) joined the game'),
+    ('leave', r'(?P<leave_player>\w+) left the game'),
+    ('chat', r'(?:\[Not Secure\] )?<(?P<chat_player>\w+)> (?P<chat_message>.*)'),
+    ('advancement', r'(?P<advancement_player>\w+) has (?:made the advancement|completed the challenge|reached the goal) \[(?P<advancement_name>[^\]]+)\]'),
+    ('lag', r"Can't keep up! Is the server overloaded\? Running (?P<lag_ms>\d+)ms or (?P<lag_ticks>\d+) ticks behind"),
+    ('crash', r'(?:This crash report has been saved to: (?P<crash_report>.+)|Encountered an unexpected exception|The server has crashed|Exception stopping the server)'),
+    ('death', r'(?P<death_player>\w+) (?P<death_cause>(?:{}).*)'.format('|'.join(DEATH_CAUSES))),
+    )
+EVENT_RE = re.compile('|'.join('(?P<{}>{})'.format(name, pattern) for name, pattern in EVENT_PATTERNS))
+EVENT_TYPES = tuple(name for name, pattern in EVENT_PATTERNS)
+
+def parse_line(line):
+    line_match = LINE_RE.match(line)
+    if line_match is None:
+        return None
+    event_match = EVENT_RE.match(line_match.group('message'))
+    if event_match is None:
+        return None
+    event_type = event_match.lastgroup
+    event = {'type': event_type, 'time': line_match.group('time')}
+    prefix = event_type + '_'
+    for key, value in event_match.groupdict().items():
+        if value is not None and key.startswith(prefix):
+            event[key[len(prefix):]] = value
+    return event
+
+class EventEngine:
+    # Turns console lines into typed events. Fed synchronously from the
+    # console reader, so it only does one regex match per line and hands
+    # events to bounded subscriber queues without waiting on anybody.
+    def __init__(self, *, max_recent=1000):
+        self._recent = collections.deque(maxlen=max_recent)
+        self._subscriptions = set()
+        self._handlers = collections.defaultdict(list)
+        self._seq = 0
+        self.counts = collections.Counter()
+
+    def add_handler(self, event_type, handler):
+        # handler(event) is called synchronously for every event of that type.
+        self._handlers[event_type].append(handler)
+
+    def feed(self, line):
+        event = parse_line(line)
+        if event is None:
+            return
+        self._seq += 1
+        event['seq'] = self._seq
+        self._recent.append(event)
+        self.counts[event['type']] += 1
+        for subscription in self._subscriptions:
+            subscription.offer(event)
+        for handler in self._handlers.get(event['type'], ()):
+            handler(event)
+
+    def recent(self, count, types=None):
+        events = [x for x in self._recent if types is None or x['type'] in types]
+        return events[max(0, len(events) - int(count)):]
+
+    def subscribe(self, types=None, maxsize=1000):
+        accept = None
+        if types is not None:
+            types = frozenset(types)
+            accept = lambda event: event['type'] in types
+        return Subscription(self._subscriptions, maxsize, accept)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+import statistics
+
+from minecraft_config import MinecraftConfig
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# cgroup v1 reports "no limit" as a huge page-aligned number.
+CGROUP_V1_UNLIMITED = 1 << 60
+
+def _read_first(*filenames):
+    for filename in filenames:
+        try:
+            with open(filename, 'r') as f:
+                return f.read().strip()
+        except OSError:
+            pass
+    return None
+
+def read_limits(root=CGROUP_ROOT):
+    limits = {'memory': None, 'memory_source': None, 'cpus': None, 'cpus_source': None}
+
+    memory = _read_first(os.path.join(root, "memory.max"))
+    if memory is not None:
+        if memory != 'max':
+            limits['memory'], limits['memory_source'] = int(memory), 'cgroup2'
+    else:
+        memory = _read_first(os.path.join(root, "memory", "memory.limit_in_bytes"))
+        if memory is not None and int(memory) < CGROUP_V1_UNLIMITED:
+            limits['memory'], limits['memory_source'] = int(memory), 'cgroup1'
+    if limits['memory'] is None:
+        limits['memory'], limits['memory_source'] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'), 'host'
+
+    cpu = _read_first(os.path.join(root, "cpu.max"))
+    if cpu is not None:
+        quota, _, period = cpu.partition(' ')
+        if quota != 'max':
+            limits['cpus'], limits['cpus_source'] = int(quota) / int(period or 100000), 'cgroup2'
+    else:
+        quota = _read_first(os.path.join(root, "cpu", "cpu.cfs_quota_us"), os.path.join(root, "cpu,cpuacct", "cpu.cfs_quota_us"))
+        period = _read_first(os.path.join(root, "cpu", "cpu.cfs_period_us"), os.path.join(root, "cpu,cpuacct", "cpu.cfs_period_us"))
+        if quota is not None and period is not None and int(quota) > 0:
+            limits['cpus'], limits['cpus_source'] = int(quota) / int(period), 'cgroup1'
+    if limits['cpus'] is None:
+        limits['cpus'], limits['cpus_source'] = float(os.cpu_count() or 1), 'host'
+    return limits
+
+SIZE_RE = re.compile(r'^(\d+)([KMGT]?)B?$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(value):
+    match = SIZE_RE.match(str(value).strip())
+    if match is None:
+        raise ValueError("{!r} is not a size like 512M or 6G".format(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+# https://docs.papermc.io/paper/aikars-flags
+AIKAR_FLAGS = [
+    '-XX:+UseG1GC', '-XX:+ParallelRefProcEnabled', '-XX:MaxGCPauseMillis=200', '-XX:+UnlockExperimentalVMOptions',
+    '-XX:+DisableExplicitGC', '-XX:+AlwaysPreTouch', '-XX:G1HeapWastePercent=5', '-XX:G1MixedGCCountTarget=4',
+    '-XX:G1MixedGCLiveThresholdPercent=90', '-XX:G1RSetUpdatingPauseTimePercent=5', '-XX:SurvivorRatio=32',
+    '-XX:+PerfDisableSharedMem', '-XX:MaxTenuringThreshold=1',
+    '-Dusing.aikars.flags=https://mcflags.emc.gs', '-Daikars.new.flags=true',
+    ]
+AIKAR_SMALL_HEAP_FLAGS = [
+    '-XX:G1NewSizePercent=30', '-XX:G1MaxNewSizePercent=40', '-XX:G1HeapRegionSize=8M',
+    '-XX:G1ReservePercent=20', '-XX:InitiatingHeapOccupancyPercent=15',
+    ]
+AIKAR_LARGE_HEAP_FLAGS = [
+    '-XX:G1NewSizePercent=40', '-XX:G1MaxNewSizePercent=50', '-XX:G1HeapRegionSize=16M',
+    '-XX:G1ReservePercent=15', '-XX:InitiatingHeapOccupancyPercent=20',
+    ]
+ZGC_FLAGS = ['-XX:+UseZGC', '-XX:+AlwaysPreTouch', '-XX:+DisableExplicitGC', '-XX:+PerfDisableSharedMem']
+# Generational ZGC is opt-in on 21 and 22 and the default from 23, which
+# deprecates the flag. 17 refuses to start with it.
+ZGC_GENERATIONAL_FLAG = '-XX:+ZGenerational'
+ZGC_GENERATIONAL_VERSIONS = (21, 22)
+
+# JAVA_VERSION="21.0.2" in an install's release file, or the first line of
+# java -version: openjdk version "17.0.10" 2024-01-16 (or "1.8.0_402").
+JAVA_RELEASE_RE = re.compile(r'^JAVA_VERSION="([\d._]+)', re.MULTILINE)
+JAVA_VERSION_RE = re.compile(r'version "([\d._]+)')
+
+def _major_version(version):
+    parts = version.split('.')
+    return int(parts[1] if parts[0] == '1' and len(parts) > 1 else parts[0])
+
+_java_versions = {}
+
+def java_version(java_exe):
+    # Major version of the JVM java_exe runs, or None if it can't be told.
+    # From the install's release file when there is one, which saves
+    # starting a JVM to ask.
+    java = os.path.realpath(shutil.which(java_exe) or java_exe)
+    try:
+        st = os.stat(java)
+    except OSError:
+        return None
+    key = (java, st.st_size, st.st_mtime_ns)
+    if key not in _java_versions:
+        match = JAVA_RELEASE_RE.search(_read_first(os.path.join(os.path.dirname(os.path.dirname(java)), "release")) or '')
+        if match is None:
+            try:
+                output = subprocess.run([java, '-version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30).stdout
+                match = JAVA_VERSION_RE.search(output.decode('utf-8', 'replace'))
+            except (OSError, subprocess.TimeoutExpired):
+                match = None
+        _java_versions[key] = _major_version(match.group(1)) if match is not None else None
+    return _java_versions[key]
+
+class LaunchProfile:
+    # Works out the java command line for a world. Settings come from the
+    # constructor, overridden per world by jvm.properties next to
+    # server.properties:
+    #
+    #   profile=aikar|zgc|none
+    #   heap=6G                (fixed -Xms/-Xmx instead of sizing from limits)
+    #   headroom=0.2           (fraction of the memory limit left for non-heap)
+    #   min_headroom=768M
+    #   extra_flags=-XX:+Foo -Dbar=baz
+    profiles = ('aikar', 'zgc', 'none')
+    MIN_HEAP = 512 << 20
+
+    def __init__(self, world_path, *, profile='aikar', headroom=0.2, min_headroom=768 << 20, filename="jvm.properties"):
+        self._world_path = world_path
+        self._filename = filename
+        self._defaults = {'profile': profile, 'headroom': headroom, 'min_headroom': min_headroom}
+
+    def _settings(self):
+        config = MinecraftConfig(self._world_path, self._filename)
+        settings = dict(self._defaults)
+        settings.update((key, value) for key, value in config.items() if not key.startswith('__'))
+        if settings['profile'] not in self.profiles:
+            raise ValueError("profile must be one of {}".format(', '.join(self.profiles)))
+        return settings
+
+    def heap_size(self, settings, limits):
+        if settings.get('heap'):
+            return parse_size(settings['heap'])
+        memory = limits['memory']
+        headroom = max(memory * float(settings['headroom']), parse_size(settings['min_headroom']))
+        # Round down to whole MiB, the JVM doesn't care for odd sizes.
+        return max(self.MIN_HEAP, int(memory - headroom) >> 20 << 20)
+
+    def flags(self, limits=None, java_exe="java"):
+        settings = self._settings()
+        if limits is None:
+            limits = read_limits()
+        flags = []
+        if settings['profile'] != 'none':
+            if settings.get('heap') or limits['memory_source'] != 'host':
+                heap = self.heap_size(settings, limits)
+                flags += ['-Xms{}M'.format(heap >> 20), '-Xmx{}M'.format(heap >> 20)]
+            else:
+                # Not in a memory-limited container: the host's RAM isn't all
+                # ours, so leave the heap at the JVM's default of a quarter.
+                heap = limits['memory'] // 4
+            if settings['profile'] == 'aikar':
+                flags += AIKAR_FLAGS + (AIKAR_LARGE_HEAP_FLAGS if heap > (12 << 30) else AIKAR_SMALL_HEAP_FLAGS)
+            else:
+                flags += ZGC_FLAGS
+                if java_version(java_exe) in ZGC_GENERATIONAL_VERSIONS:
+                    flags.append(ZGC_GENERATIONAL_FLAG)
+            if limits['cpus_source'] != 'host':
+                flags.append('-XX:ActiveProcessorCount={}'.format(max(1, round(limits['cpus']))))
+        flags += settings.get('extra_flags', '').split()
+        return flags
+
+    def command(self, java_exe, jar_file, limits=None, extra_flags=()):
+        return [java_exe, *self.flags(limits, java_exe), *extra_flags, "-jar", jar_file]
+
+# Dynamic archives (-XX:ArchiveClassesAtExit) arrived in JDK 13.
+APPCDS_MIN_VERSION = 13
+# The JVM's own CDS complaints in unified logging, e.g.
+# [0.013s][warning][cds] ... or [0.02s][error  ][cds,dynamic] ...
+CDS_LOG_RE = re.compile(r'\[[^\]]*\]\[(warning|error)\s*\]\[cds')
+
+class AppCDSArchive:
+    # A dynamic class-data-sharing archive per (server jar, JVM) pair. The
+    # first start records one with -XX:ArchiveClassesAtExit, which the JVM
+    # writes on a clean shutdown; later starts map it with
+    # -XX:SharedArchiveFile. Archives for any other jar or JVM are stale and
+    # get deleted. Startup times are kept for both kinds of start so the
+    # difference can be reported.
+    MAX_SAMPLES = 20
+
+    def __init__(self, world_path, jar_file, java_exe, *, directory=".appcds"):
+        self._path = os.path.join(world_path, directory)
+        self._jar_file = jar_file
+        self._java_exe = java_exe
+        self._jar_key = None
+        self._jar_stat = None
+        self.mode = None
+        self.archive = None
+        self.disabled_reason = None
+
+    def _key(self):
+        st = os.stat(self._jar_file)
+        if self._jar_stat != (st.st_size, st.st_mtime_ns):
+            digest = hashlib.sha256()
+            with open(self._jar_file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self._jar_key = digest.hexdigest()[:16]
+            self._jar_stat = (st.st_size, st.st_mtime_ns)
+        # The JVM is identified by its binary and, if there is one, the
+        # release file of its install.
+        java = os.path.realpath(shutil.which(self._java_exe) or self._java_exe)
+        jvm = hashlib.sha256()
+        java_st = os.stat(java)
+        jvm.update('{}:{}:{}'.format(java, java_st.st_size, java_st.st_mtime_ns).encode('utf-8'))
+        release = os.path.join(os.path.dirname(os.path.dirname(java)), "release")
+        if os.path.exists(release):
+            with open(release, 'rb') as f:
+                jvm.update(f.read())
+        return "{}-{}".format(self._jar_key, jvm.hexdigest()[:16])
+
+    def flags(self):
+        version = java_version(self._java_exe)
+        if version is None or version < APPCDS_MIN_VERSION:
+            # Older JVMs refuse to start with the flags at all.
+            self.mode = 'disabled'
+            self.disabled_reason = "AppCDS needs JDK {} or later, and {} is {}.".format(
+                APPCDS_MIN_VERSION, self._java_exe, "JDK {}".format(version) if version is not None else "of unknown version")
+            print(self.disabled_reason, file=sys.stderr)
+            return []
+        self.disabled_reason = None
+        os.makedirs(self._path, exist_ok=True)
+        key = self._key()
+        self.archive = os.path.join(self._path, key + ".jsa")
+        for name in os.listdir(self._path):
+            if name.endswith(".jsa") and name != key + ".jsa":
+                os.unlink(os.path.join(self._path, name))
+        if os.path.exists(self.archive):
+            self.mode = 'use'
+            return ['-XX:SharedArchiveFile={}'.format(self.archive)]
+        self.mode = 'create'
+        return ['-XX:ArchiveClassesAtExit={}'.format(self.archive)]
+
+    def check_line(self, line):
+        # The JVM carries on without a bad archive but says so on stdout.
+        # Drop it so the next clean shutdown records a fresh one.
+        # Only the JVM's log lines: a player saying "[cds] error" in chat
+        # shouldn't cost the archive.
+        if self.mode == 'use' and CDS_LOG_RE.match(line):
+            self.invalidate()
+
+    def invalidate(self):
+        if self.archive is not None and os.path.exists(self.archive):
+            os.unlink(self.archive)
+
+    def _load_stats(self):
+        try:
+            with open(os.path.join(self._path, "stats.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def record_startup(self, seconds):
+        # Starts that record an archive run the same as starts without one.
+        if self.mode == 'disabled':
+            return {'mode': self.mode, 'reason': self.disabled_reason}
+        stats = self._load_stats()
+        key = os.path.basename(self.archive)[:-4]
+        if stats.get('key') != key:
+            stats = {'key': key, 'with_archive': [], 'without_archive': []}
+        samples = stats['with_archive' if self.mode == 'use' else 'without_archive']
+        samples.append(round(seconds, 3))
+        del samples[:-self.MAX_SAMPLES]
+        with open(os.path.join(self._path, "stats.json"), 'w', encoding='utf-8') as f:
+            json.dump(stats, f)
+        report = {'mode': self.mode, 'archive': self.archive}
+        if stats['with_archive'] and stats['without_archive']:
+            report['median_with_archive'] = statistics.median(stats['with_archive'])
+            report['median_without_archive'] = statistics.median(stats['without_archive'])
+            report['saved'] = round(report['median_without_archive'] - report['median_with_archive'], 3)
+        return report
@@ -1,48 +1,251 @@
 #!/usr/bin/env python3
 import asyncio
 import os
-import struct
 import json
 import signal
 import sys
+import time
 
 from minecraft_process import MinecraftProcess
+from minecraft_archive import CODECS
+from minecraft_jvm import LaunchProfile
+from minecraft_client import MinecraftClient, FRAME_SIZE, MAX_FRAME_SIZE
+from minecraft_metrics import REGISTRY, serve_http
+
+SOCKET_CALL_SECONDS = REGISTRY.histogram('minecraft_socket_call_seconds', 'Time to answer a socket call.', ('instance', 'method', 'result'))
+SOCKET_CONNECTIONS = REGISTRY.counter('minecraft_socket_connections_total', 'Socket connections accepted.', ('protocol',))
 
 class MinecraftSocketServer:
-    allowed_methods = ('start', 'query', 'do_backup', 'say', 'ban', 'unban', 'whitelist', 'unwhitelist', 'whitelistctl', 'op', 'deop', 'stop')
+    class FrameTooLarge(Exception): pass
+
+    allowed_methods = ('start', 'query', 'do_backup', 'say', 'ban', 'unban', 'whitelist', 'unwhitelist', 'whitelistctl', 'op', 'deop', 'stop',
+                       'ban_many', 'unban_many', 'whitelist_many', 'unwhitelist_many', 'op_many', 'deop_many', 'console_tail', 'events_recent',
+                       'stats', 'players', 'banlist', 'cache_stats', 'player_info', 'roster_entries',
+                       'supervisor_stats', 'pregen_start', 'pregen_status', 'pregen_stop')
+    # These return an async iterator instead of a reply. Each item is sent as
+    # an {"id", "event"} frame, and only persistent connections can use them.
+    streaming_methods = ('console_subscribe', 'events_subscribe')
+    # Answered by the socket server itself rather than a Minecraft process.
+    server_methods = ('metrics', 'instances')
+
+    max_in_flight = 64
+    # Requests a persistent connection can have waiting for one of the
+    # max_in_flight slots. Beyond that they're refused rather than left
+    # unread, so cancels still get through.
+    max_queued = 256
 
     def __init__(self, loop):
-        self._mc_process = None
+        # name -> MinecraftProcess, all run from this one event loop. Methods
+        # are sent to one as "name/method"; a bare method goes to the first.
+        self._instances = {}
+        self._default_instance = None
         self._server = None
         self._loop = loop
         self._sigint_default = None
         self._sigterm_default = None
 
-    async def _connection_handler(self, reader, writer):
-        size = struct.unpack("I", await reader.readexactly(4))[0]
-        raw_json = await reader.readexactly(size)
-        
+    async def _read_frame(self, reader):
+        size = FRAME_SIZE.unpack(await reader.readexactly(FRAME_SIZE.size))[0]
+        if size > MAX_FRAME_SIZE:
+            # The frame is left unread, so the connection can't be used again.
+            raise self.__class__.FrameTooLarge('Frame of {} bytes is too large.'.format(size))
+        return await reader.readexactly(size)
+
+    def _write_frame(self, writer, obj):
+        raw = json.dumps(obj).encode('utf-8')
+        writer.write(FRAME_SIZE.pack(len(raw)) + raw)
+
+    def _resolve(self, method):
+        # "name/method" -> (instance name, MinecraftProcess, method).
+        if not isinstance(method, str):
+            raise RuntimeError('A method name must be a string')
+        name, _, method = method.rpartition('/')
+        if not name:
+            name = self._default_instance
+        if name not in self._instances:
+            raise RuntimeError('{} is not an instance'.format(name))
+        return name, self._instances[name], method
+
+    async def _call(self, call):
+        start_time = time.monotonic()
+        # Unknown names are lumped together to keep the label sets bounded.
+        instance, label = '', 'invalid'
         try:
-            decoded_json = json.loads(raw_json.decode('utf-8'))
-            if isinstance(decoded_json, list) and decoded_json:
-                method = decoded_json[0]
-                args = decoded_json[1:]
-                
+            if not isinstance(call, list) or not call:
+                raise RuntimeError('A call must be a list of [method, args...]')
+            method = call[0]
+            args = call[1:]
+
+            if method in self.server_methods:
+                label, method = method, getattr(self, method)
+            else:
+                name, mc_process, method = self._resolve(method)
+                if method in self.streaming_methods:
+                    raise RuntimeError('{} is only available on persistent connections'.format(method))
                 if method not in self.allowed_methods:
                     raise RuntimeError('{} is not an allowed method'.format(method))
-                
-                method = getattr(self._mc_process, method)
-                reply = [True] + list(await method(*args))
+                instance, label, method = name, method, getattr(mc_process, method)
+
+            reply = [True] + list(await method(*args))
+            SOCKET_CALL_SECONDS.observe(time.monotonic() - start_time, instance, label, 'success' if reply[1] else 'failure')
+            return reply
         except Exception as ex:
-            reply = [False, None, repr(ex)]
-        
-        writer.write(json.dumps(reply).encode('utf-8'))
-        
+            SOCKET_CALL_SECONDS.observe(time.monotonic() - start_time, instance, label, 'error')
+            return [False, None, repr(ex)]
+
+    async def instances(self):
+        return True, {name: {
+            'world': mc_process.world_path,
+            'default': name == self._default_instance,
+            'pid': (await mc_process.query())[1],
+            } for name, mc_process in self._instances.items()}
+
+    async def metrics(self, fmt='json'):
+        # fmt is json for a structured snapshot or prometheus for the text
+        # exposition format.
+        if fmt == 'prometheus':
+            return True, REGISTRY.render()
+        if fmt == 'json':
+            return True, REGISTRY.snapshot()
+        return False, 'fmt must be json or prometheus.'
+
+    def _is_stream(self, call):
+        return isinstance(call, list) and call and isinstance(call[0], str) and call[0].rpartition('/')[2] in self.streaming_methods
+
+    async def _stream(self, request_id, call, writer):
+        try:
+            name, mc_process, method = self._resolve(call[0])
+            method = getattr(mc_process, method)
+            async for item in method(*call[1:]):
+                self._write_frame(writer, {'id': request_id, 'event': item})
+                await writer.drain()
+            return [True, True, None]
+        except Exception as ex:
+            return [False, None, repr(ex)]
+
+    async def _request(self, request, writer, in_flight):
+        async with in_flight:
+            call = request.get('call')
+            if 'batch' in request:
+                if not isinstance(request['batch'], list):
+                    self._write_frame(writer, {'id': request.get('id'), 'reply': [False, None, 'A batch must be a list of calls.']})
+                else:
+                    if request.get('parallel'):
+                        replies = await asyncio.gather(*[self._call(x) for x in request['batch']])
+                    else:
+                        replies = [await self._call(x) for x in request['batch']]
+                    self._write_frame(writer, {'id': request.get('id'), 'replies': list(replies)})
+            elif self._is_stream(call):
+                self._write_frame(writer, {'id': request.get('id'), 'reply': await self._stream(request.get('id'), call, writer)})
+            else:
+                self._write_frame(writer, {'id': request.get('id'), 'reply': await self._call(call)})
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def _session(self, first_request, reader, writer):
+        # Persistent mode: the connection carries any number of
+        # {"id": ..., "call": [...]} or {"id": ..., "batch": [[...], ...]}
+        # frames, each answered with a frame carrying the same id as soon as
+        # it finishes, regardless of order.
+        # {"cancel": id} stops a request, which is how streams are ended.
+        # Requests wait for a slot in their own task, so the connection keeps
+        # being read while max_in_flight of them run. An id can't be reused
+        # until its request has been answered.
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = {}
+        streams = set()
+        request = first_request
+        try:
+            while True:
+                if isinstance(request, dict) and 'cancel' in request:
+                    task = tasks.get(request['cancel'])
+                    if task is not None:
+                        task.cancel()
+                elif isinstance(request, dict) and request.get('id') in tasks:
+                    self._write_frame(writer, {'id': request.get('id'), 'reply': [False, None, 'A request with this id is still in flight.']})
+                elif isinstance(request, dict) and len(tasks) >= self.max_in_flight + self.max_queued:
+                    self._write_frame(writer, {'id': request.get('id'), 'reply': [False, None, 'Too many requests in flight.']})
+                elif isinstance(request, dict):
+                    task = asyncio.ensure_future(self._request(request, writer, in_flight))
+                    tasks[request.get('id')] = task
+                    if 'batch' not in request and self._is_stream(request.get('call')):
+                        streams.add(task)
+                    task.add_done_callback(lambda task, request_id=request.get('id'): (tasks.pop(request_id, None), streams.discard(task)))
+                else:
+                    self._write_frame(writer, {'id': None, 'reply': [False, None, 'Requests must be objects.']})
+                try:
+                    request = json.loads((await self._read_frame(reader)).decode('utf-8'))
+                except (ValueError, UnicodeDecodeError) as ex:
+                    request = None
+                    self._write_frame(writer, {'id': None, 'reply': [False, None, repr(ex)]})
+        except self.__class__.FrameTooLarge as ex:
+            # Closing the connection still sends this.
+            self._write_frame(writer, {'id': None, 'reply': [False, None, repr(ex)]})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Streams have nobody left to stream to. Anything else runs to
+            # the end, as it would have on the one-shot protocol: cutting a
+            # backup short mid-way does more harm than finishing it.
+            for task in list(streams):
+                task.cancel()
+
+    async def _connection_handler(self, reader, writer):
+        try:
+            try:
+                first_request = json.loads((await self._read_frame(reader)).decode('utf-8'))
+            except (ValueError, UnicodeDecodeError, self.__class__.FrameTooLarge) as ex:
+                first_request = None
+                reply = [False, None, repr(ex)]
+            if isinstance(first_request, dict):
+                SOCKET_CONNECTIONS.inc(1, 'persistent')
+                await self._session(first_request, reader, writer)
+            else:
+                SOCKET_CONNECTIONS.inc(1, 'oneshot')
+                # Original protocol: one list, one unprefixed reply, then close.
+                if first_request is not None:
+                    reply = await self._call(first_request)
+                writer.write(json.dumps(reply).encode('utf-8'))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
 
-    async def start(self, socket, world, minecraft_jar):
-        self._mc_process = MinecraftProcess(minecraft_jar, world)
-        print('Server starting...', file=sys.stderr)
-        await self._mc_process.start()
+    async def start(self, socket, worlds, minecraft_jar, metrics_port=None, max_jobs=1, **process_options):
+        # worlds is {name: (world path, jar or None for minecraft_jar)}. Every
+        # instance shares one semaphore for heavy jobs, so at most max_jobs
+        # backups run on the host at once.
+        job_semaphore = asyncio.Semaphore(max_jobs)
+        # Worlds without ports of their own get consecutive ones. RCON ports
+        # start at the usual 25575 unless there are more than ten worlds, in
+        # which case they start after the last game port instead.
+        rcon_base = max(25575, 25565 + len(worlds))
+        for i, (name, (world, jar)) in enumerate(worlds.items()):
+            jar = jar or minecraft_jar
+            self._instances[name] = MinecraftProcess(jar, world, name=name, job_semaphore=job_semaphore,
+                                                     server_port=25565 + i, rcon_port=rcon_base + i, **process_options)
+        self._default_instance = next(iter(self._instances))
+        # A second server on a port that's taken fails to bind, and its RCON
+        # connection would end up at the first one's server, where "b/stop"
+        # stops world a.
+        claimed = {}
+        for name, mc_process in self._instances.items():
+            for key, port in mc_process.ports().items():
+                if port in claimed:
+                    raise ValueError("{} {} of instance {} is already the {} of instance {}. Give each world ports of its own in its server.properties.".format(
+                        key, port, name, *claimed[port]))
+                claimed[port] = (key, name)
+        # One at a time: a JVM starting up is heavy on its own.
+        for name, mc_process in self._instances.items():
+            print('Server {} starting...'.format(name), file=sys.stderr)
+            await mc_process.start()
+
+        if metrics_port is not None:
+            # Local only. Publish it from the container if you mean to.
+            await serve_http(metrics_port)
         
         self._server = await asyncio.start_unix_server(self._connection_handler, socket)
         await self._server.wait_closed()
@@ -52,8 +255,7 @@ class MinecraftSocketServer:
     
     async def teardown(self):
         self._server.close()
-        self._mc_process.terminate()
-        await self._mc_process.wait()
+        await asyncio.gather(*[x.stop() for x in self._instances.values()], return_exceptions=True)
         await self._server.wait_closed()
         
     def set_signal_handlers(self):
@@ -84,7 +286,25 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--socket', type=os.path.realpath, required=True, help="Location of socket file.")
     parser.add_argument('-w', '--world', type=os.path.realpath, default=None, help="Location of minecraft world.")
     parser.add_argument('-j', '--minecraft-jar', type=os.path.realpath, default=None, help="Location of minecraft JAR file.")
+    parser.add_argument('--instance', action='append', default=[], metavar='NAME=WORLD[,JAR]', help="Run another world from this process. (Repeatable. -w is the instance called default.)")
+    parser.add_argument('--max-jobs', type=int, default=1, help="Backups allowed to run at once across all instances.")
+    parser.add_argument('-t', '--target', default=None, help="Instance to send the command to. (Default: the first one.)")
+    parser.add_argument('--backup-mode', choices=MinecraftProcess.backup_modes, default='tar', help="tar for a full .tar.bz2 per backup, archive for a full archive compressed on every core, chunked for an incremental content-addressed store.")
+    parser.add_argument('--backup-keep', type=int, default=None, help="Number of chunked backups to keep. (Default: all)")
+    parser.add_argument('--backup-workers', type=int, default=None, help="Compression processes for archive backups. (Default: one per core)")
+    parser.add_argument('--backup-codec', choices=sorted(CODECS), default='gzip', help="Compression codec for archive backups.")
+    parser.add_argument('--backup-level', type=int, default=None, help="Compression level for archive backups.")
+    parser.add_argument('--backup-ionice', choices=sorted(MinecraftProcess.ionice_classes), default=None, help="I/O priority class for the backup process.")
+    parser.add_argument('--backup-throttle-mspt', type=float, default=None, help="Pause the backup process whenever ticks take longer than this many milliseconds.")
+    parser.add_argument('--no-backup-staging', dest='backup_staging', action='store_false', help="Archive straight from the world with saving off, instead of from a copy taken with saving off.")
+    parser.add_argument('--jvm-profile', choices=LaunchProfile.profiles, default='aikar', help="JVM flag set. Heap is sized from the container's memory limit. (Overridable per world in jvm.properties.)")
+    parser.add_argument('--appcds', action='store_true', help="Record a class-data-sharing archive on the first clean shutdown and start from it afterwards.")
+    parser.add_argument('--stats-interval', type=float, default=5.0, help="Seconds between performance samples. 0 turns sampling off.")
+    parser.add_argument('--cache-ttl', type=float, default=2.0, help="Seconds to serve whitelist, player and ban lists from cache. Changes made through this script clear it straight away.")
+    parser.add_argument('--supervise', action='store_true', help="Restart the server if it crashes or stops responding.")
+    parser.add_argument('--metrics-port', type=int, default=None, help="Serve Prometheus metrics over HTTP on this port of 127.0.0.1.")
     parser.add_argument('--accept-eula', action='store_true', help="Agree to the Minecraft EULA for the active world.")
+    parser.add_argument('--diff', action='store_true', help="For the *_many commands, only send changes against the current list.")
     parser.add_argument('command', nargs='?', default=None, help="Command to send to running server.")
     parser.add_argument('args', nargs='*', default=None, help="Command arguments.")
     args = parser.parse_args()
@@ -94,39 +314,88 @@ if __name__ == "__main__":
             f.write("eula=true\n")
 
     elif args.command is None:
-        if args.world is None or args.minecraft_jar is None:
-            print("In order to start a minecraft server, you must specify -w and -j.", file=sys.stderr)
-            print("Allowed commands:", ' '.join(MinecraftSocketServer.allowed_methods), file=sys.stderr)
+        worlds = {}
+        if args.world is not None:
+            worlds['default'] = (args.world, args.minecraft_jar)
+        for instance in args.instance:
+            name, _, world = instance.partition('=')
+            world, _, jar = world.partition(',')
+            if not name or '/' in name or not world or name in worlds:
+                print("--instance takes a unique NAME=WORLD[,JAR], and names can't contain /.", file=sys.stderr)
+                sys.exit(1)
+            worlds[name] = (os.path.realpath(world), os.path.realpath(jar) if jar else args.minecraft_jar)
+        if not worlds or any(jar is None for world, jar in worlds.values()):
+            print("In order to start a minecraft server, you must specify -w (or --instance) and -j.", file=sys.stderr)
+            print("Allowed commands:", ' '.join(MinecraftSocketServer.allowed_methods + MinecraftSocketServer.server_methods), file=sys.stderr)
             sys.exit(1)
 
         loop = asyncio.get_event_loop()
         socket_server = MinecraftSocketServer(loop)
         socket_server.set_signal_handlers()
-        loop.run_until_complete(socket_server.start(args.socket, args.world, args.minecraft_jar))
+        try:
+            loop.run_until_complete(socket_server.start(args.socket, worlds, args.minecraft_jar, max_jobs=args.max_jobs,
+                backup_mode=args.backup_mode, backup_keep=args.backup_keep, backup_staging=args.backup_staging,
+                backup_workers=args.backup_workers, backup_codec=args.backup_codec, backup_level=args.backup_level, backup_ionice=args.backup_ionice,
+                backup_throttle_mspt=args.backup_throttle_mspt, jvm_profile=args.jvm_profile, appcds=args.appcds,
+                stats_interval=args.stats_interval, cache_ttl=args.cache_ttl, supervise=args.supervise,
+                metrics_port=args.metrics_port))
+        except ValueError as ex:
+            print(ex, file=sys.stderr)
+            sys.exit(1)
         loop.close()
 
     else:
         to_send = [args.command]
         if args.command == 'say' and len(args.args) > 0:
             to_send.append(' '.join(args.args))
-        elif args.command in ('start', 'query', 'do_backup', 'stop') and len(args.args) == 0:
+        elif args.command in ('start', 'query', 'do_backup', 'stop', 'events_recent', 'stats', 'metrics',
+                              'players', 'banlist', 'cache_stats', 'supervisor_stats', 'instances',
+                              'pregen_status', 'pregen_stop') and len(args.args) == 0:
             pass
-        elif args.command in ('unban', 'whitelist', 'whitelistctl', 'unwhitelist', 'op', 'deop') and len(args.args) == 1:
+        elif args.command in ('unban', 'whitelist', 'whitelistctl', 'unwhitelist', 'op', 'deop', 'stats', 'metrics', 'banlist',
+                              'player_info', 'roster_entries') and len(args.args) == 1:
             to_send.append(args.args[0])
+        elif args.command == 'pregen_start' and 1 <= len(args.args) <= 4:
+            # radius [x z [mode]]
+            to_send += [int(x) for x in args.args[:3]] + args.args[3:]
+        elif args.command in ('console_tail', 'console_subscribe') and len(args.args) <= 1:
+            to_send += [int(x) for x in args.args]
+        elif args.command == 'events_recent' and len(args.args) >= 1:
+            to_send += [int(args.args[0]), args.args[1:] or None]
+        elif args.command == 'events_subscribe':
+            to_send.append(args.args or None)
         elif args.command in ('ban') and len(args.args) > 0:
             to_send += args.args[0:2]
+        elif args.command in ('ban_many', 'unban_many', 'whitelist_many', 'unwhitelist_many', 'op_many', 'deop_many') and len(args.args) > 0:
+            to_send += [args.args, args.diff]
         else:
             print("Command not found or wrong number of arguments.", file=sys.stderr)
             sys.exit(1)
 
-        import socket
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        print_raw = to_send == ['metrics', 'prometheus']
+        if args.target is not None and to_send[0] not in MinecraftSocketServer.server_methods:
+            to_send[0] = '{}/{}'.format(args.target, to_send[0])
+
+        async def send_command(path, call):
+            client = MinecraftClient(path)
+            await client.connect()
+            try:
+                if call[0].rpartition('/')[2] in MinecraftSocketServer.streaming_methods:
+                    async for event in client.subscribe(*call):
+                        print(json.dumps(event), flush=True)
+                    return None
+                return await client.call(*call)
+            finally:
+                await client.close()
+
         try:
-            s.connect(args.socket)
-        except FileNotFoundError:
+            reply = asyncio.run(send_command(args.socket, to_send))
+        except (FileNotFoundError, ConnectionRefusedError):
             print('Unable to find socket. Server not running?', file=sys.stderr)
             sys.exit(1)
-        raw = json.dumps(to_send).encode('utf-8')
-        s.send(struct.pack("I", len(raw)) + raw)
-        print(s.recv(65535).decode('utf-8'))
-
+        except KeyboardInterrupt:
+            sys.exit(0)
+        if reply is not None and print_raw and reply[1]:
+            print(reply[2], end='')
+        elif reply is not None:
+            print(json.dumps(reply))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import asyncio
+import bisect
+import math
+
+# Seconds, from a fast RCON round trip up to a long backup.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, (), value
+
+    def snapshot(self):
+        return [{'labels': dict(zip(self.labelnames, x)), 'value': y} for x, y in self.values.items()]
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+class Histogram:
+    # Counts per bucket are kept non-cumulative, so an observation is one
+    # bisect and two additions. Exporting does the summing.
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for le, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels, (('le', _format_value(le)),), cumulative
+            yield self.name + '_sum', labels, (), total
+            yield self.name + '_count', labels, (), cumulative
+
+    def snapshot(self):
+        result = []
+        for labels, (counts, total) in self.values.items():
+            count = sum(counts)
+            result.append({
+                'labels': dict(zip(self.labelnames, labels)),
+                'count': count,
+                'sum': round(total, 6),
+                'mean': round(total / count, 6) if count else None,
+                'buckets': {_format_value(le): x for le, x in zip(self.buckets + (math.inf,), counts) if x},
+                })
+        return result
+
+class Registry:
+    # Nothing here is locked: everything is updated from the event loop.
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} already registered.".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4.
+        lines = []
+        for metric in self._metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, extra, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(metric.labelnames, labels, extra), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {name: {'type': metric.type, 'values': metric.snapshot()} for name, metric in self._metrics.items()}
+
+REGISTRY = Registry()
+
+async def _http_handler(registry, reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Headers aren't needed, but have to be read past.
+        while (await reader.readline()).strip():
+            pass
+        method, path, *_ = request_line.decode('latin-1').split() + ['', '']
+        if method != 'GET':
+            status, body = '405 Method Not Allowed', 'Only GET is supported.\n'
+        elif path.split('?')[0] not in ('/', '/metrics'):
+            status, body = '404 Not Found', 'Metrics are at /metrics.\n'
+        else:
+            status, body = '200 OK', registry.render()
+        body = body.encode('utf-8')
+        writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            status, len(body)).encode('latin-1') + body)
+        await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_http(port, host='127.0.0.1', registry=REGISTRY):
+    # A bare HTTP/1.0 server for Prometheus to scrape. The registry is only
+    # rendered when somebody asks for it.
+    return await asyncio.start_server(lambda reader, writer: _http_handler(registry, reader, writer), host, port)
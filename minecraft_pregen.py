@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import asyncio
+import collections
+import itertools
+import json
+import os
+import time
+
+def spiral(radius):
+    # Chunk offsets in rings out from (0, 0), covering the square of side
+    # 2 * radius + 1. Ring r is the 8r chunks on that square's edge.
+    yield 0, 0
+    for r in range(1, radius + 1):
+        for x in range(-r, r + 1):
+            yield x, -r
+        for z in range(-r + 1, r + 1):
+            yield r, z
+        for x in range(r - 1, -r - 1, -1):
+            yield x, r
+        for z in range(r - 1, -r, -1):
+            yield -r, z
+
+class PregenJob:
+    # Generates the chunks within radius blocks of (x, z) by force loading
+    # them a batch at a time, in spiral order so the area nearest spawn is
+    # done first. Progress is saved after every batch, so a job picks up
+    # where it left off after a restart.
+    #
+    # In 'idle' mode it only runs while nobody is online; in 'throttled'
+    # mode it runs regardless but, like 'idle', waits whenever ticks take
+    # longer than target_mspt.
+    modes = ('idle', 'throttled')
+    FILENAME = "pregen.json"
+    # For servers that only report TPS.
+    MIN_TPS = 19.0
+
+    def __init__(self, world_path, command, tick_health, player_count, job_slot, *, radius, x=0, z=0, mode='throttled',
+                 target_mspt=40.0, batch_size=16, load_timeout=60.0, wait_interval=10.0, max_rate_samples=30):
+        if mode not in self.modes:
+            raise ValueError("mode must be one of {}".format(', '.join(self.modes)))
+        try:
+            radius, x, z, target_mspt = int(radius), int(x), int(z), float(target_mspt)
+        except (TypeError, ValueError):
+            raise ValueError("radius, x and z must be integers and target_mspt a number.")
+        if radius <= 0:
+            raise ValueError("radius must be positive.")
+        self._filename = os.path.join(world_path, self.FILENAME)
+        self._command = command
+        self._tick_health = tick_health
+        self._player_count = player_count
+        self._job_slot = job_slot
+        self._batch_size = batch_size
+        self._load_timeout = load_timeout
+        self._wait_interval = wait_interval
+        self._rate_samples = collections.deque(maxlen=max_rate_samples)
+        self._task = None
+        # Falls back to a fixed wait on servers without `execute if loaded`.
+        self._can_check_loaded = True
+        self.settings = {'radius': radius, 'x': x, 'z': z, 'mode': mode, 'target_mspt': target_mspt}
+        chunk_radius = -(-radius // 16)
+        self.total = (2 * chunk_radius + 1) ** 2
+        self.done = 0
+        self.elapsed = 0.0
+        self.state = 'new'
+        self.error = None
+        saved = self.load(world_path)
+        # Mode and target_mspt don't change the order chunks are done in.
+        if saved is not None and all(saved['settings'][key] == self.settings[key] for key in ('radius', 'x', 'z')):
+            self.done, self.elapsed = min(saved['done'], self.total), saved['elapsed']
+
+    @classmethod
+    def load(cls, world_path):
+        # The saved job with its settings checked, or None if there isn't one
+        # or it doesn't hold together (say, edited by hand).
+        try:
+            with open(os.path.join(world_path, cls.FILENAME), 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            settings = saved['settings']
+            settings = {'radius': int(settings['radius']), 'x': int(settings['x']), 'z': int(settings['z']), 'mode': settings['mode'],
+                        # Not saved before it could be set per job.
+                        'target_mspt': float(settings.get('target_mspt', 40.0))}
+            saved = {'settings': settings, 'total': int(saved['total']), 'done': int(saved['done']), 'elapsed': float(saved['elapsed']),
+                     'state': saved['state'], 'error': saved.get('error')}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            return None
+        if settings['mode'] not in cls.modes or settings['radius'] <= 0 or saved['done'] < 0 or not isinstance(saved['state'], str):
+            return None
+        return saved
+
+    def _save(self):
+        temp_filename = self._filename + ".tmp"
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump({'settings': self.settings, 'total': self.total, 'done': self.done, 'elapsed': round(self.elapsed, 3),
+                       'state': self.state, 'error': self.error}, f)
+        os.replace(temp_filename, self._filename)
+
+    async def _wait_for_window(self):
+        while True:
+            if self.settings['mode'] == 'idle':
+                players = await self._player_count()
+                if players is None or players > 0:
+                    self.state = 'waiting for players to leave'
+                    await asyncio.sleep(self._wait_interval)
+                    continue
+            health = await self._tick_health()
+            if health is not None and (health.get('mspt', 0) > self.settings['target_mspt'] or health.get('tps', 20) < self.MIN_TPS):
+                self.state = 'waiting for ticks to recover'
+                await asyncio.sleep(self._wait_interval)
+                continue
+            self.state = 'running'
+            return
+
+    async def _generate(self, batch):
+        # Block coordinates of each chunk's corner.
+        positions = [(((self.settings['x'] >> 4) + cx) << 4, ((self.settings['z'] >> 4) + cz) << 4) for cx, cz in batch]
+        results = await asyncio.gather(*[self._command('forceload', 'add', str(x), str(z), success_re=r'^Marked') for x, z in positions])
+        # Chunks that were already force loaded belong to somebody else.
+        added = [position for position, (success, response) in zip(positions, results) if success]
+        try:
+            pending = list(positions)
+            deadline = time.monotonic() + self._load_timeout
+            while pending and time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+                if not self._can_check_loaded:
+                    # Nothing to poll; give the batch a fixed second per chunk.
+                    await asyncio.sleep(len(batch))
+                    break
+                results = await asyncio.gather(*[self._command('execute', 'if', 'loaded', str(x), '0', str(z), success_re=r'^Test passed')
+                                                 for x, z in pending])
+                if not any(success or response.startswith('Test failed') for success, response in results):
+                    self._can_check_loaded = False
+                pending = [position for position, (success, response) in zip(pending, results) if not success]
+        finally:
+            await asyncio.gather(*[self._command('forceload', 'remove', str(x), str(z)) for x, z in added])
+
+    async def _run(self):
+        chunk_radius = -(-self.settings['radius'] // 16)
+        chunks = itertools.islice(spiral(chunk_radius), self.done, None)
+        self._rate_samples.append((time.monotonic(), self.done))
+        try:
+            while True:
+                batch = list(itertools.islice(chunks, self._batch_size))
+                if not batch:
+                    self.state = 'done'
+                    self._save()
+                    return
+                await self._wait_for_window()
+                # One batch per slot, so backups can get in between.
+                async with self._job_slot('pregen'):
+                    start_time = time.monotonic()
+                    await self._generate(batch)
+                    self.elapsed += time.monotonic() - start_time
+                self.done += len(batch)
+                self._rate_samples.append((time.monotonic(), self.done))
+                self._save()
+        except Exception as ex:
+            # Left alone by the next start, like a stopped job.
+            self.state = 'failed'
+            self.error = repr(ex)
+            try:
+                self._save()
+            except OSError:
+                pass
+
+    def start(self):
+        self.state = 'running'
+        self.error = None
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, state='stopped'):
+        # state 'interrupted' (the server went away) is resumed by the next
+        # start; 'stopped' (somebody asked) isn't.
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.state not in ('done', 'failed'):
+            self.state = state
+            self._save()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def status(self):
+        rate = None
+        if len(self._rate_samples) >= 2:
+            (first_time, first_done), (last_time, last_done) = self._rate_samples[0], self._rate_samples[-1]
+            if last_time > first_time:
+                rate = (last_done - first_done) / (last_time - first_time)
+        remaining = self.total - self.done
+        return {
+            **self.settings,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'percent': round(100.0 * self.done / self.total, 2),
+            'chunks_per_second': round(rate, 3) if rate is not None else None,
+            'eta_seconds': round(remaining / rate) if rate else None,
+            'generating_seconds': round(self.elapsed, 3),
+            'error': self.error,
+            }
@@ -3,13 +3,70 @@ import asyncio
 import os
 import datetime
 import re
+import sys
+import json
+import time
 import base64
+import random
+import shutil
+import contextlib
+import signal
 
-from rcon import RCONMessage, MinecraftRCON
+from rcon import RCONMessage, MinecraftRCONPool
 from minecraft_config import MinecraftConfig
+from minecraft_backup import sync_tree
+from minecraft_archive import CODECS, zstandard
+from minecraft_throttle import BackupThrottle
+from minecraft_console import ConsoleBuffer
+from minecraft_events import EventEngine
+from minecraft_jvm import LaunchProfile, AppCDSArchive, read_limits
+from minecraft_stats import PerfStats, parse_perf_counters, PLAYERS_RE, ENTITIES_RE, CHUNKS_RE
+from minecraft_metrics import REGISTRY
+from minecraft_cache import CommandCache
+from minecraft_roster import RosterIndex
+from minecraft_supervisor import Supervisor
+from minecraft_pregen import PregenJob
+
+BACKUP_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "minecraft_backup.py")
+ARCHIVE_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "minecraft_archive.py")
+
+RCON_SECONDS = REGISTRY.histogram('minecraft_rcon_request_seconds', 'RCON request round trip time.', ('instance',))
+RCON_SENT_BYTES = REGISTRY.counter('minecraft_rcon_sent_bytes_total', 'Bytes sent over RCON.', ('instance',))
+RCON_RECEIVED_BYTES = REGISTRY.counter('minecraft_rcon_received_bytes_total', 'Bytes received over RCON.', ('instance',))
+RCON_TIMEOUTS = REGISTRY.counter('minecraft_rcon_timeouts_total', 'RCON requests that timed out.', ('instance',))
+COMMAND_LOCK_WAIT_SECONDS = REGISTRY.histogram('minecraft_command_lock_wait_seconds', 'Time spent waiting for the command lock.', ('instance', 'holder'))
+JOB_QUEUE_SECONDS = REGISTRY.histogram('minecraft_job_queue_seconds', 'Time heavy jobs spent waiting for a host-wide slot.', ('instance', 'job'))
+BACKUP_SECONDS = REGISTRY.histogram('minecraft_backup_seconds', 'Backup duration.', ('instance', 'mode'))
+BACKUP_SAVE_OFF_SECONDS = REGISTRY.histogram('minecraft_backup_save_off_seconds', 'Time autosave was off during a backup.', ('instance', 'mode'))
+BACKUP_READ_BYTES = REGISTRY.counter('minecraft_backup_read_bytes_total', 'Bytes of world data read by backups.', ('instance', 'mode'))
+BACKUP_WRITTEN_BYTES = REGISTRY.counter('minecraft_backup_written_bytes_total', 'Bytes written by backups.', ('instance', 'mode'))
+BACKUP_THROUGHPUT = REGISTRY.gauge('minecraft_backup_throughput_bytes_per_second', 'World data read (archive written, for tar) per second by the last backup.', ('instance', 'mode'))
+BACKUPS = REGISTRY.counter('minecraft_backups_total', 'Backups run.', ('instance', 'mode', 'result'))
 
 class MinecraftProcess:
-    def __init__(self, jar_file, world_path, *, java_exe="java", backup_path=None):
+    backup_modes = ('tar', 'archive', 'chunked')
+    reconnect_initial_delay = 0.25
+    reconnect_max_delay = 5.0
+    # Heap and GC figures take a jcmd, which is a JVM of its own, so they're
+    # sampled far less often than the RCON ones.
+    jvm_stats_interval = 60.0
+    # RCON connections per server. Each carries one command at a time.
+    rcon_connections = 4
+    # Commands a bulk operation keeps in flight. The server runs them one
+    # at a time anyway, and this leaves connections free for everybody else.
+    bulk_in_flight = 2
+    ionice_classes = {'idle': ['-c', '3'], 'best-effort': ['-c', '2', '-n', '7']}
+
+    def __init__(self, jar_file, world_path, *, java_exe="java", backup_path=None, rcon_timeout=30, backup_mode='tar', backup_keep=None, backup_staging=True,
+                 backup_workers=None, backup_codec='gzip', backup_level=None, backup_ionice=None, backup_throttle_mspt=None,
+                 jvm_profile='aikar', appcds=False, stats_interval=5.0, cache_ttl=2.0, supervise=False, name='default', job_semaphore=None,
+                 server_port=25565, rcon_port=25575):
+        # name labels this instance's metrics. job_semaphore, if given, is
+        # shared with other instances on the host and held for heavy jobs
+        # like backups so they don't all hit the disk at once. server_port
+        # and rcon_port are written to server.properties if it has none.
+        self.name = name
+        self._job_semaphore = job_semaphore
         self._jar_file = os.path.realpath(jar_file)
         self._world_path = os.path.realpath(world_path)
         self._java_exe = java_exe
@@ -20,6 +77,58 @@ class MinecraftProcess:
         self._command_lock = asyncio.Lock()
         self._rcon_port = None
         self._rcon_password = None
+        self._rcon_timeout = rcon_timeout
+        self._default_ports = {'server-port': server_port, 'rcon.port': rcon_port}
+        if backup_mode not in self.backup_modes:
+            raise ValueError("backup_mode must be one of {}".format(', '.join(self.backup_modes)))
+        self._backup_mode = backup_mode
+        self._backup_keep = backup_keep
+        self._backup_staging = backup_staging
+        self._backup_workers = backup_workers
+        if backup_codec not in CODECS:
+            raise ValueError("backup_codec must be one of {}".format(', '.join(CODECS)))
+        if backup_codec == 'zstd' and zstandard is None:
+            # Otherwise every backup fails in the archive process.
+            raise ValueError("backup_codec zstd needs the zstandard package, which isn't installed")
+        self._backup_codec = backup_codec
+        self._backup_level = backup_level
+        if backup_ionice is not None and backup_ionice not in self.ionice_classes:
+            raise ValueError("backup_ionice must be one of {}".format(', '.join(self.ionice_classes)))
+        self._backup_ionice = backup_ionice
+        self._backup_throttle_mspt = backup_throttle_mspt
+        self._tick_health_cmd = None
+        self._console = ConsoleBuffer()
+        self._console_task = None
+        self._events = EventEngine()
+        self._console.add_listener(self._events.feed)
+        self._launch_profile = LaunchProfile(self._world_path, profile=jvm_profile)
+        self._launch = None
+        self._appcds = AppCDSArchive(self._world_path, self._jar_file, self._java_exe) if appcds else None
+        if self._appcds is not None:
+            self._console.add_listener(self._appcds.check_line)
+        self._stats = PerfStats()
+        self._stats_interval = stats_interval
+        self._stats_task = None
+        self._stats_unsupported = set()
+        self._last_gc = None
+        self._last_jvm_sample = None
+        self._jvm_stats_error = None
+        # Read-only command results, so polling dashboards don't cost an RCON
+        # round trip each. Joins and leaves change the player list.
+        self._cache = CommandCache(cache_ttl)
+        self._rosters = RosterIndex(self._world_path)
+        self._stopping = False
+        self._waiter_task = None
+        self._supervisor = Supervisor(self) if supervise else None
+        self._pregen = None
+        if self._supervisor is not None:
+            self._events.add_handler('lag', self._supervisor.tick_stalled)
+        for event_type in ('join', 'leave'):
+            self._events.add_handler(event_type, lambda event: self._cache.invalidate('players'))
+        self._startup_marks = None
+        self._startup_events = {'started': asyncio.Event(), 'rcon_ready': asyncio.Event()}
+        for event_type in self._startup_events:
+            self._events.add_handler(event_type, self._startup_mark)
         
         if backup_path is None:
             self._backup_path = os.path.join(self._world_path, "backups")
@@ -29,12 +138,55 @@ class MinecraftProcess:
             self._backup_path = os.path.realpath(backup_path)
         
 
+    @property
+    def world_path(self):
+        return self._world_path
+
+    def _observe_rcon(self, seconds, bytes_sent, bytes_received, timed_out):
+        RCON_SECONDS.observe(seconds, self.name)
+        RCON_SENT_BYTES.inc(bytes_sent, self.name)
+        RCON_RECEIVED_BYTES.inc(bytes_received, self.name)
+        if timed_out:
+            RCON_TIMEOUTS.inc(1, self.name)
+
+    @contextlib.asynccontextmanager
+    async def _job_slot(self, job):
+        # Returns how long the slot took to come free.
+        wait_start = time.monotonic()
+        if self._job_semaphore is None:
+            yield 0.0
+            return
+        async with self._job_semaphore:
+            queued = time.monotonic() - wait_start
+            JOB_QUEUE_SECONDS.observe(queued, self.name, job)
+            yield queued
+
+    @contextlib.asynccontextmanager
+    async def _locked(self, holder):
+        # The command lock, timed: a long wait here is a command stuck
+        # behind a backup or a reconnect.
+        wait_start = time.monotonic()
+        async with self._command_lock:
+            COMMAND_LOCK_WAIT_SECONDS.observe(time.monotonic() - wait_start, self.name, holder)
+            yield
+
     async def _process_waiter(self):
         if self._process is not None:
-            await self._process.wait()
+            returncode = await self._process.wait()
             self._process = None
             self._rcon_port = None
             self._rcon_password = None
+            if self._stats_task is not None:
+                self._stats_task.cancel()
+                self._stats_task = None
+            if self._comms is not None and not self._stopping:
+                # Dead along with the server. stop() closes its own.
+                await self._comms.close()
+                self._comms = None
+            if self._pregen is not None and self._pregen.running:
+                await self._pregen.stop('interrupted')
+            if self._supervisor is not None:
+                self._supervisor.process_exited(returncode, self._stopping)
             
     def _force_enable_rcon(self):
         #['broadcast-rcon-to-ops', 'rcon.port', 'enable-rcon', 'rcon.password']
@@ -43,9 +195,10 @@ class MinecraftProcess:
         if config.get('enable-rcon', 'false') != 'true':
             config['enable-rcon'] = 'true'
             changed = True
-        if 'rcon.port' not in config:
-            config['rcon.port'] = '25575'
-            changed = True
+        for key, port in self._default_ports.items():
+            if key not in config:
+                config[key] = str(port)
+                changed = True
         if not config.get('rcon.password', ''):
             config['rcon.password'] = base64.b64encode(os.urandom(48), b'./').decode('ascii')
             changed = True
@@ -53,124 +206,535 @@ class MinecraftProcess:
             config.save()
         return int(config['rcon.port']), config['rcon.password']
         
+    def ports(self):
+        # The server's game and RCON ports, as of its next start.
+        config = MinecraftConfig(self._world_path)
+        return {key: int(config.get(key, port)) for key, port in self._default_ports.items()}
+
+    def _startup_mark(self, event):
+        if self._startup_marks is not None:
+            self._startup_marks.setdefault(event['type'], (time.monotonic(), event))
+            self._startup_events[event['type']].set()
+
     async def start(self):
         if self._process is not None:
             return False, 'Process already started. (pid={})'.format(self._process.pid)
         
         self._rcon_port, self._rcon_password = self._force_enable_rcon()
+
+        # Heap and GC flags are worked out fresh on every start, so changes to
+        # the container's limits or jvm.properties apply on restart.
+        limits = read_limits()
+        try:
+            extra_flags = self._appcds.flags() if self._appcds is not None else []
+            command = self._launch_profile.command(self._java_exe, self._jar_file, limits, extra_flags)
+        except ValueError as ex:
+            return False, 'Bad JVM launch settings: {}'.format(ex)
+        self._launch = {'command': command, 'limits': limits}
         
+        self._stopping = False
+        self._startup_marks = {}
+        for event in self._startup_events.values():
+            event.clear()
+        start_time = time.monotonic()
         self._process = await asyncio.create_subprocess_exec(
-            self._java_exe, "-jar", self._jar_file, cwd=self._world_path,
+            *command, cwd=self._world_path,
             stdin=asyncio.subprocess.DEVNULL,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.DEVNULL
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
             )
+        timings = {'jvm_spawn': time.monotonic() - start_time}
+        pid = self._process.pid
 
-        asyncio.ensure_future(self._process_waiter())
+        self._console_task = asyncio.ensure_future(self._console.read_stream(self._process.stdout))
+        self._waiter_task = asyncio.ensure_future(self._process_waiter())
 
         await self._reconnect()
         if self._process is None:
             return False, "Process started but didn't stay up."
         if self._comms is None:
-            return False, "Process started but couldn't establish RCON connection. (pid={})".format(self._process.pid)
-        return True, "Process started and RCON connection established. (pid={})".format(self._process.pid) 
+            return False, "Process started but couldn't establish RCON connection. (pid={})".format(pid)
+        timings['rcon_ready'] = time.monotonic() - start_time
+
+        # RCON comes up just before the "Done" line, so give it a moment.
+        if not self._startup_events['started'].is_set():
+            try:
+                await asyncio.wait_for(self._startup_events['started'].wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+        marks, self._startup_marks = self._startup_marks, None
+        if self._process is None:
+            # Exited during the wait; _process_waiter has cleaned up.
+            return False, "Process started but exited while loading. (pid={})".format(pid)
+        if 'started' in marks:
+            timings['world_load'] = marks['started'][0] - start_time
+            timings['reported_done'] = float(marks['started'][1]['seconds'])
+        if 'rcon_ready' in marks:
+            timings['rcon_listening'] = marks['rcon_ready'][0] - start_time
+        if self._appcds is not None:
+            timings['appcds'] = self._appcds.record_startup(timings.get('world_load', timings['rcon_ready']))
+        if self._stats_interval:
+            self._stats_unsupported.clear()
+            self._last_gc = None
+            self._last_jvm_sample = None
+            self._jvm_stats_error = None
+            self._stats_task = asyncio.ensure_future(self._sample_stats())
+        if self._supervisor is not None:
+            self._supervisor.process_started()
+        saved = PregenJob.load(self._world_path)
+        if saved is not None and saved['state'] not in ('done', 'stopped', 'failed'):
+            # Interrupted by a restart or crash.
+            await self.pregen_start(**saved['settings'])
+        return True, "Process started and RCON connection established. (pid={})".format(pid), timings
 
-    async def _reconnect(self):
+    async def _reconnect(self, deadline=None):
+        # The console says when RCON is listening, so normally the second
+        # attempt connects. The backoff only matters if that line never shows
+        # up (unknown log format) or the connection drops later on.
+        delay = self.reconnect_initial_delay
         while self._process is not None:
-            new_comms = MinecraftRCON("127.0.0.1", self._rcon_port)
+            new_comms = MinecraftRCONPool("127.0.0.1", self._rcon_port, self._rcon_password, size=self.rcon_connections,
+                                          timeout=self._rcon_timeout, observer=self._observe_rcon)
+            # Connections are authenticated before the pool hands them out,
+            # so commands never go out on an unauthenticated socket.
             try:
-                await new_comms.connect()
-            except ConnectionRefusedError:
-                print('Connection refused.')
-                await asyncio.sleep(3)
-            except Exception:
-                print('another exception?')
-                await asyncio.sleep(3)
-            else:
-                print('Connection worked.')
-                self._comms = new_comms
-                break
-        
-        if self._comms is not None:
-            if not await self._comms.send_password(self._rcon_password):
-                await self._comms.close()
-                self._comms = None
+                if await new_comms.connect():
+                    self._comms = new_comms
+                return
+            except (OSError, asyncio.TimeoutError):
+                pass
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            wait = delay * random.uniform(0.5, 1.5)
+            delay = min(delay * 2, self.reconnect_max_delay)
+            rcon_ready = self._startup_events['rcon_ready']
+            if rcon_ready.is_set():
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await asyncio.wait_for(rcon_ready.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
 
     async def query(self):
         if self._process is not None:
-            return True, self._process.pid
+            return True, self._process.pid, self._launch
         return False, None
 
+    # Paper's mspt, Spigot's tps and vanilla's (1.20.3+) tick query all report
+    # tick health in different shapes. Whichever answers first gets used from
+    # then on.
+    tick_health_cmds = (
+        (('mspt',), re.compile(r'from last[^:]*:\D*([\d.]+)/'), 'mspt'),
+        (('tps',), re.compile(r'TPS from last[^:]*:\s*\*?([\d.]+)'), 'tps'),
+        (('tick', 'query'), re.compile(r'Average time per tick: ([\d.]+)ms'), 'mspt'),
+        )
+
+    async def _tick_health(self):
+        cmds = self.tick_health_cmds if self._tick_health_cmd is None else [self._tick_health_cmd]
+        for tick_health_cmd in cmds:
+            cmd, health_re, key = tick_health_cmd
+            success, response = await self._command_template(*cmd, timeout=5)
+            match = health_re.search(re.sub('\u00a7.', '', response))
+            if match is not None:
+                self._tick_health_cmd = tick_health_cmd
+                return {key: float(match.group(1))}
+            if self._process is None:
+                break
+        return None
+
+    # (metric, command, regex for the count). Commands the server doesn't
+    # have are dropped until the next start.
+    stats_count_cmds = (
+        ('players', ('list',), PLAYERS_RE),
+        ('entities', ('execute', 'if', 'entity', '@e'), ENTITIES_RE),
+        ('chunks', ('paper', 'chunkinfo', '*'), CHUNKS_RE),
+        )
+
+    def _jdk_tool(self, name):
+        # jcmd and friends ship next to java in a JDK, which needn't be on PATH.
+        java = shutil.which(self._java_exe)
+        return (shutil.which(name, path=os.path.dirname(os.path.realpath(java))) if java else None) or shutil.which(name)
+
+    async def _jvm_stats(self, pid):
+        # Through jcmd's attach API rather than jstat, which can't see a JVM
+        # run with -XX:+PerfDisableSharedMem (both default profiles are).
+        jcmd = self._jdk_tool('jcmd')
+        if jcmd is None:
+            self._jvm_stats_error = 'jcmd not found.'
+            return {}
+        proc = await asyncio.create_subprocess_exec(
+            jcmd, str(pid), 'PerfCounter.print',
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+            )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), 30)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            self._jvm_stats_error = 'jcmd timed out.'
+            return {}
+        output = stdout.decode('utf-8', 'replace')
+        gc = parse_perf_counters(output) if proc.returncode == 0 else None
+        if gc is None:
+            self._jvm_stats_error = 'jcmd failed: {}'.format(output.strip()[-200:])
+            return {}
+        self._jvm_stats_error = None
+        # GC time and count are cumulative, so report them per sample.
+        sample = {x: gc[x] for x in ('heap_used', 'heap_committed') if x in gc}
+        if self._last_gc is not None:
+            sample['gc_ms'] = (gc['gc_time'] - self._last_gc['gc_time']) * 1000
+            sample['gc_count'] = gc['gc_count'] - self._last_gc['gc_count']
+        self._last_gc = gc
+        return sample
+
+    async def _sample(self):
+        sample = {}
+        health = await self._tick_health()
+        if health is not None:
+            sample.update(health)
+            if 'tps' not in sample:
+                sample['tps'] = min(20.0, 1000.0 / sample['mspt']) if sample['mspt'] > 0 else 20.0
+        for metric, cmd, count_re in self.stats_count_cmds:
+            if metric in self._stats_unsupported:
+                continue
+            success, response = await self._command_template(*cmd, timeout=5)
+            matches = list(count_re.finditer(re.sub('\u00a7.', '', response)))
+            if matches:
+                sample[metric] = float(sum(int(x.group(1) or 0) for x in matches))
+            elif success:
+                self._stats_unsupported.add(metric)
+        now = time.monotonic()
+        if self._process is not None and (self._last_jvm_sample is None or now - self._last_jvm_sample >= self.jvm_stats_interval):
+            self._last_jvm_sample = now
+            sample.update(await self._jvm_stats(self._process.pid))
+        return sample
+
+    async def _sample_stats(self):
+        # Polls on a fixed schedule rather than a fixed gap, so slow replies
+        # don't stretch the interval. Samples that can't keep up are skipped
+        # rather than bunched up.
+        next_sample = time.monotonic()
+        while self._process is not None:
+            try:
+                self._stats.add(time.time(), await self._sample())
+            except (OSError, ConnectionError):
+                pass
+            next_sample = max(next_sample + self._stats_interval, time.monotonic())
+            await asyncio.sleep(next_sample - time.monotonic())
+
+    async def _player_count(self):
+        success, response = await self._command_template('list', success_re=r'^There (are|is)')
+        match = PLAYERS_RE.search(response) if success else None
+        return int(match.group(1)) if match is not None else None
+
+    async def pregen_start(self, radius, x=0, z=0, mode='throttled', target_mspt=40.0):
+        # Generates the square of chunks within radius blocks of (x, z) in
+        # the overworld. Starting the same area again resumes it.
+        if self._pregen is not None and self._pregen.running:
+            return False, 'Pregeneration already running. Stop it first.'
+        if self._process is None:
+            return False, 'Minecraft process is not running. You can start it again by calling "start".'
+        try:
+            self._pregen = PregenJob(self._world_path, self._command_template, self._tick_health, self._player_count, self._job_slot,
+                                     radius=radius, x=x, z=z, mode=mode, target_mspt=target_mspt)
+        except ValueError as ex:
+            return False, str(ex)
+        self._pregen.start()
+        return True, self._pregen.status()
+
+    async def pregen_status(self):
+        if self._pregen is not None:
+            return True, self._pregen.status()
+        saved = PregenJob.load(self._world_path)
+        if saved is None:
+            return False, 'No pregeneration has been run in this world.'
+        return True, dict(saved['settings'], state=saved['state'], done=saved['done'], total=saved['total'], error=saved['error'])
+
+    async def pregen_stop(self):
+        if self._pregen is None or not self._pregen.running:
+            return False, 'Pregeneration is not running.'
+        await self._pregen.stop()
+        return True, self._pregen.status()
+
+    async def stats(self, resolution=None):
+        # Percentiles for every resolution, or the full series for one.
+        summary = self._stats.summary(resolution, series=resolution is not None)
+        summary['unsupported'] = sorted(self._stats_unsupported)
+        summary['jvm_stats_error'] = self._jvm_stats_error
+        return True, summary
+
+    def _backup_command(self, world_folders, source_path):
+        if self._backup_mode == 'chunked':
+            # Content-addressed store: only chunks that changed since the last
+            # snapshot get written, and each backup is just a manifest.
+            store_path = os.path.join(self._backup_path, "store")
+            cmd = [sys.executable, BACKUP_SCRIPT, '--store', store_path, 'backup', '--root', source_path]
+            if self._backup_keep is not None:
+                cmd += ['--keep', str(self._backup_keep)]
+            return store_path, cmd + world_folders
+        if self._backup_mode == 'archive':
+            # Compressed on every core, still a plain .tar.<ext>.
+            backup_filename = os.path.join(self._backup_path, "{}.tar.{}".format(
+                datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), CODECS[self._backup_codec][0]))
+            cmd = [sys.executable, ARCHIVE_SCRIPT, '--codec', self._backup_codec, '--root', source_path, '--output', backup_filename]
+            if self._backup_level is not None:
+                cmd += ['--level', str(self._backup_level)]
+            if self._backup_workers is not None:
+                cmd += ['--workers', str(self._backup_workers)]
+            return backup_filename, cmd + world_folders
+        backup_filename = os.path.join(self._backup_path, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".tar.bz2")
+        return backup_filename, ['tar', '-cjf', backup_filename, *world_folders]
+
+    async def _run_backup(self, world_folders, source_path):
+        # Backups can run long, so spin it off in a separate process.
+        backup_target, backup_cmd = self._backup_command(world_folders, source_path)
+        if self._backup_ionice is not None and shutil.which('ionice'):
+            # Let the game's own disk access go first.
+            backup_cmd = ['ionice', *self.ionice_classes[self._backup_ionice], *backup_cmd]
+        self._backup_process = await asyncio.create_subprocess_exec(
+            *backup_cmd, cwd=source_path,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True
+            )
+        throttle = None
+        if self._backup_throttle_mspt is not None:
+            # Own session, so the throttle can pause compression workers too.
+            throttle = BackupThrottle(self._tick_health, target_mspt=self._backup_throttle_mspt)
+            throttle.start(self._backup_process.pid)
+        try:
+            stdout, stderr = await self._backup_process.communicate()
+        except asyncio.CancelledError:
+            # Don't leave an archiver running that the lock no longer covers.
+            try:
+                os.killpg(self._backup_process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self._backup_process = None
+            raise
+        finally:
+            throttle_result = await throttle.stop() if throttle is not None else None
+        retcode = self._backup_process.returncode
+        self._backup_process = None
+        return backup_target, retcode, stdout.decode('utf-8'), stderr.decode('utf-8'), throttle_result
+
     async def do_backup(self):
         if self._backup_lock.locked():
             return False, "Backup already in progress."
-        async with self._backup_lock, self._command_lock:
-            # Do the prep work
-            await self._comms.send_command('say', 'Backing up the world...')
-            await self._comms.send_command('save-off')
-            try:
-                await self._comms.send_command('save-all')
+        async with self._backup_lock, self._job_slot('backup') as queued:
+            details = {'queued_seconds': queued}
+            async with self._locked('backup'):
+                # Do the prep work
+                await self._comms.send_command('say', 'Backing up the world...')
+                await self._comms.send_command('save-off')
+                save_off_start = time.monotonic()
+                try:
+                    await self._comms.send_command('save-all', 'flush')
 
-                world_folders = ['world']
-                if os.path.exists('world_nether'):
-                    world_folders.append('world_nether')
-                if os.path.exists('world_the_end'):
-                    world_folders.append('world_the_end')
-        
-                # Backups can run long, so spin it off in a separate process.
-                backup_filename = os.path.join(self._backup_path, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".tar.bz2")
-                self._backup_process = await asyncio.create_subprocess_exec(
-                    'tar', '-cjf', backup_filename, *world_folders,
-                    stdin=asyncio.subprocess.DEVNULL,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                    )
-                stdout, stderr = await self._backup_process.communicate()
-                retcode = self._backup_process.returncode
-                self._backup_process = None
-        
-                # Cleanup
-                if retcode == 0:
-                    await self._comms.send_command('say', '... backup done!')
-                    return True, "Backed up world to {}".format(backup_filename)
-                await self._comms.send_command('say', '... backup FAILED!')
-                return False, "Failed to back up world to {}. (return={})".format(backup_filename, retcode), stdout.decode('utf-8'), stderr.decode('utf-8')
-            finally:
-                await self._comms.send_command('save-on')
+                    world_folders = ['world']
+                    if os.path.exists(os.path.join(self._world_path, 'world_nether')):
+                        world_folders.append('world_nether')
+                    if os.path.exists(os.path.join(self._world_path, 'world_the_end')):
+                        world_folders.append('world_the_end')
+
+                    if self._backup_staging:
+                        # Phase one: copy the world aside while saving is off.
+                        # Compressing from that copy can then happen with
+                        # saving back on.
+                        source_path = os.path.join(self._backup_path, "staging")
+                        details['snapshot'] = await asyncio.get_running_loop().run_in_executor(
+                            None, sync_tree, self._world_path, world_folders, source_path)
+                    else:
+                        source_path = self._world_path
+                        backup_result = await self._run_backup(world_folders, source_path)
+                finally:
+                    await self._comms.send_command('save-on')
+                    details['save_off_seconds'] = time.monotonic() - save_off_start
+
+            if self._backup_staging:
+                backup_result = await self._run_backup(world_folders, source_path)
+            backup_target, retcode, stdout, stderr, throttle_result = backup_result
+            if throttle_result is not None:
+                details['throttle'] = throttle_result
+            details['backup_seconds'] = time.monotonic() - save_off_start
+            BACKUP_SECONDS.observe(details['backup_seconds'], self.name, self._backup_mode)
+            BACKUP_SAVE_OFF_SECONDS.observe(details['save_off_seconds'], self.name, self._backup_mode)
+
+            # Cleanup
+            if retcode == 0:
+                await self._command_template('say', '... backup done!')
+                if self._backup_mode in ('archive', 'chunked'):
+                    details.update(json.loads(stdout))
+                else:
+                    details['bytes_written'] = os.path.getsize(backup_target)
+                # tar doesn't say how much it read, so its throughput is
+                # measured on the archive instead.
+                if 'bytes_read' in details:
+                    BACKUP_READ_BYTES.inc(details['bytes_read'], self.name, self._backup_mode)
+                BACKUP_WRITTEN_BYTES.inc(details['bytes_written'], self.name, self._backup_mode)
+                if details['backup_seconds'] > 0:
+                    BACKUP_THROUGHPUT.set(details.get('bytes_read', details['bytes_written']) / details['backup_seconds'], self.name, self._backup_mode)
+                BACKUPS.inc(1, self.name, self._backup_mode, 'success')
+                return True, "Backed up world to {}".format(backup_target), details
+            BACKUPS.inc(1, self.name, self._backup_mode, 'failure')
+            await self._command_template('say', '... backup FAILED!')
+            return False, "Failed to back up world to {}. (return={})".format(backup_target, retcode), stdout, stderr
 
     async def say(self, what):
-        async with self._command_lock:
-            await self._comms.send_command('say', what)
-            return True, None
+        # say has no output, so anything that made it to the server counts.
+        success, response = await self._command_template('say', what, success_re=r'')
+        return success, None if success else response
+
+    async def _get_comms(self):
+        # Only (re)connecting is serialized. Commands themselves run on the
+        # pool's connections and don't hold the lock while in flight. A pool
+        # whose connections have all dropped is replaced, with backoff, for
+        # up to rcon_timeout.
+        if self._comms is None or not self._comms.connected:
+            async with self._locked('reconnect'):
+                if self._comms is not None and not self._comms.connected:
+                    await self._comms.close()
+                    self._comms = None
+                if self._comms is None:
+                    await self._reconnect(time.monotonic() + self._rcon_timeout)
+        return self._comms
     
-    async def _command_template(self, *cmd, success_re=None):
-        async with self._command_lock:
-            if self._process is None:
-                return False, 'Minecraft process is not running. You can start it again by calling "start".'
-            if self._comms is None:
-                await self._reconnect()
-            recv_msg = await self._comms.send_command(*cmd)
-            response = recv_msg.payload.decode('utf-8')
-            if success_re is not None:
-                success = re.match(success_re, response) is not None
-            else:
-                success = bool(response)
-            return success, response
+    async def _command_template(self, *cmd, success_re=None, timeout=None, multipacket=False, unknown_outcome=False):
+        # With unknown_outcome, a command that may or may not have run (timed
+        # out or cut off) gives None rather than False.
+        if self._process is None:
+            return False, 'Minecraft process is not running. You can start it again by calling "start".'
+        comms = await self._get_comms()
+        if comms is None:
+            return False, 'Minecraft process is running but RCON is not connected.'
+        try:
+            recv_msg = await comms.send_command(*cmd, timeout=timeout, multipacket=multipacket)
+        except asyncio.TimeoutError:
+            return None if unknown_outcome else False, 'Timed out waiting for a response to "{}".'.format(cmd[0])
+        except ConnectionError as ex:
+            # Dropped mid-command. The next command reconnects.
+            return None if unknown_outcome else False, str(ex)
+        response = recv_msg.payload.decode('utf-8')
+        if success_re is not None:
+            success = re.match(success_re, response) is not None
+        else:
+            success = bool(response)
+        return success, response
+
+    # Single-player roster commands: (command prefix, success_re, roster the
+    # command changes, whether it adds to that roster.)
+    player_commands = {
+        'ban': (('ban',), r'^Banned (\S+): (.*)', 'banlist', True),
+        'unban': (('pardon',), r'^Unbanned (\S+)', 'banlist', False),
+        'whitelist': (('whitelist', 'add'), r'^Added (\S+) to the whitelist', 'whitelist', True),
+        'unwhitelist': (('whitelist', 'remove'), r'^Removed (\S+) from the whitelist', 'whitelist', False),
+        'op': (('op',), r'^Made (\S+) a server operator', 'ops', True),
+        'deop': (('deop',), r'^Made (\S+) no longer a server operator', 'ops', False),
+        }
+
+    async def _player_command(self, name, player, *extra, unknown_outcome=False):
+        cmd, success_re, roster, adds = self.player_commands[name]
+        try:
+            return await self._command_template(*cmd, player, *extra, success_re=success_re, unknown_outcome=unknown_outcome)
+        finally:
+            self._cache.invalidate(roster)
+
+    async def _cached_command(self, tags, *cmd, **kwargs):
+        # Successful responses are served from the cache until they expire
+        # or one of tags is invalidated.
+        return await self._cache.get(cmd, lambda: self._command_template(*cmd, **kwargs), tags, cacheable=lambda result: result[0])
 
     async def ban(self, player, reason=None):
-        cmd = ['ban', player]
-        if reason is not None:
-            cmd.append(reason)
-        return await self._command_template(*cmd, success_re=r'^Banned (\S+): (.*)')
+        return await self._player_command('ban', player, *([] if reason is None else [reason]))
 
     async def unban(self, player):
-        return await self._command_template('pardon', player, success_re=r'^Unbanned (\S+)')
+        return await self._player_command('unban', player)
 
     async def whitelist(self, player):
-        return await self._command_template('whitelist', 'add', player, success_re=r'^Added (\S+) to the whitelist')
+        return await self._player_command('whitelist', player)
 
     async def unwhitelist(self, player):
-        return await self._command_template('whitelist', 'remove', player, success_re=r'^Removed (\S+) from the whitelist')
+        return await self._player_command('unwhitelist', player)
+
+    async def _roster(self, roster):
+        # Lower-cased names currently on a roster, or None if it can't be read.
+        # The server rewrites its JSON files on every change, so these are
+        # current without asking it over RCON.
+        return self._rosters[roster].names()
+
+    async def player_info(self, player):
+        # Name, UUID and whitelist/ops/banlist entries for a name or UUID.
+        # Works whether or not the server is running.
+        return True, self._rosters.player(player)
+
+    async def roster_entries(self, roster):
+        if roster not in ('whitelist', 'ops', 'banlist'):
+            return False, 'roster must be whitelist, ops or banlist.'
+        entries = self._rosters[roster].entries()
+        if entries is None:
+            return False, 'Unable to read the current {}.'.format(roster)
+        return True, entries
+
+    async def _bulk_player_command(self, name, players, diff, *extra):
+        if isinstance(players, str) or not all(isinstance(x, str) for x in players):
+            return False, 'players must be a list of player names.'
+        cmd, success_re, roster, adds = self.player_commands[name]
+        skipped = []
+        if diff:
+            current = await self._roster(roster)
+            if current is None:
+                return False, 'Unable to read the current {}.'.format(roster)
+            skipped = [x for x in players if (x.lower() in current) == adds]
+            players = [x for x in players if (x.lower() in current) != adds]
+        # A few at a time rather than all at once: the server answers one
+        # command per tick or so (whitelist add may look the player up with
+        # Mojang, too), and every command's timeout runs from when it's sent.
+        slots = asyncio.Semaphore(self.bulk_in_flight)
+
+        async def run(player):
+            async with slots:
+                return list(await self._player_command(name, player, *extra, unknown_outcome=True))
+        results = await asyncio.gather(*[run(x) for x in players])
+        unknown = [i for i, result in enumerate(results) if result[0] is None]
+        if unknown:
+            # The server may have run these anyway. Its roster file says
+            # whether it did; the rest stay unknown (None) rather than failed.
+            current = await self._roster(roster)
+            for i in unknown:
+                if current is not None and (players[i].lower() in current) == adds:
+                    results[i] = [True, 'No reply in time, but the {} shows it was done.'.format(roster)]
+        if any(result[0] is False for result in results):
+            success = False
+        elif any(result[0] is None for result in results):
+            success = None
+        else:
+            success = True
+        return success, {
+            'results': dict(zip(players, results)),
+            'skipped': skipped,
+            }
+
+    async def ban_many(self, players, diff=False, reason=None):
+        return await self._bulk_player_command('ban', players, diff, *([] if reason is None else [reason]))
+
+    async def unban_many(self, players, diff=False):
+        return await self._bulk_player_command('unban', players, diff)
+
+    async def whitelist_many(self, players, diff=False):
+        return await self._bulk_player_command('whitelist', players, diff)
+
+    async def unwhitelist_many(self, players, diff=False):
+        return await self._bulk_player_command('unwhitelist', players, diff)
+
+    async def op_many(self, players, diff=False):
+        return await self._bulk_player_command('op', players, diff)
+
+    async def deop_many(self, players, diff=False):
+        return await self._bulk_player_command('deop', players, diff)
 
     async def whitelistctl(self, ctl):
         if ctl in ('on', 'off'):
@@ -185,22 +749,161 @@ class MinecraftProcess:
             return False, f'Use the unwhitelist command instead.'
         else:
             return False, f'{ctl!s} is not a valid whitelist command'
-        return await self._command_template('whitelist', ctl, success_re=success_re)
+        if ctl == 'list':
+            # list is the one that outgrows a single 4096 byte packet.
+            return await self._cached_command(('whitelist',), 'whitelist', ctl, success_re=success_re, multipacket=True)
+        try:
+            return await self._command_template('whitelist', ctl, success_re=success_re)
+        finally:
+            if ctl == 'reload':
+                self._cache.invalidate('whitelist')
+
+    async def players(self):
+        return await self._cached_command(('players',), 'list', success_re=r'^There (are|is)', multipacket=True)
+
+    async def banlist(self, kind='players'):
+        if kind not in ('players', 'ips'):
+            return False, 'kind must be players or ips.'
+        return await self._cached_command(('banlist',), 'banlist', kind, success_re=r'^There ', multipacket=True)
+
+    async def cache_stats(self):
+        return True, self._cache.stats()
 
     async def op(self, player):
-        return await self._command_template('op', player, success_re=r'^Made (\S+) a server operator')
+        return await self._player_command('op', player)
 
     async def deop(self, player):
-        return await self._command_template('deop', player, success_re=r'^Made (\S+) no longer a server operator')
+        return await self._player_command('deop', player)
+
+    async def console_tail(self, count=100):
+        return True, self._console.tail(count)
+
+    async def console_subscribe(self, tail=0, maxsize=1000):
+        # Streaming method: yields {'seq', 'line'[, 'dropped']} items until the
+        # caller goes away.
+        subscription = self._console.subscribe(maxsize)
+        try:
+            for item in self._console.tail(tail):
+                yield item
+            async for item in subscription:
+                yield item
+        finally:
+            subscription.close()
+
+    async def events_recent(self, count=100, types=None):
+        return True, self._events.recent(count, types)
+
+    async def events_subscribe(self, types=None, maxsize=1000):
+        # Streaming method: yields join/leave/chat/death/advancement/started/
+        # lag/crash events parsed from the console.
+        subscription = self._events.subscribe(types, maxsize)
+        try:
+            async for event in subscription:
+                yield event
+        finally:
+            subscription.close()
+
+    async def heartbeat(self, timeout):
+        # Any command will do: they all wait on the server thread.
+        try:
+            return await asyncio.wait_for(self._command_template('list', timeout=timeout), timeout)
+        except asyncio.TimeoutError:
+            return False, 'Timed out.'
+
+    async def thread_dump(self):
+        # Writes the server's thread stacks to thread-dumps/ in the world and
+        # returns the file name, or None if there's no server to dump.
+        process = self._process
+        if process is None:
+            return None
+        dump_path = os.path.join(self._world_path, "thread-dumps")
+        os.makedirs(dump_path, exist_ok=True)
+        filename = os.path.join(dump_path, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".txt")
+        jcmd = self._jdk_tool('jcmd')
+        if jcmd is not None:
+            dump = await asyncio.create_subprocess_exec(
+                jcmd, str(process.pid), 'Thread.print',
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT
+                )
+            try:
+                stdout, _ = await asyncio.wait_for(dump.communicate(), 30)
+            except asyncio.TimeoutError:
+                dump.kill()
+                stdout = None
+            if stdout and dump.returncode == 0:
+                with open(filename, 'wb') as f:
+                    f.write(stdout)
+                return filename
+        # No jcmd (or it couldn't attach): the JVM prints the same thing to
+        # stdout on SIGQUIT, which ends up in the console buffer.
+        subscription = self._console.subscribe(100000)
+        try:
+            process.send_signal(signal.SIGQUIT)
+            lines = []
+            while True:
+                try:
+                    lines.append((await asyncio.wait_for(subscription.__anext__(), 2))['line'])
+                except asyncio.TimeoutError:
+                    break
+        except ProcessLookupError:
+            return None
+        finally:
+            subscription.close()
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return filename
+
+    async def kill(self, grace=30):
+        # For a server that won't listen to "stop". Returns once the exit has
+        # been dealt with.
+        process = self._process
+        if process is None:
+            return False, 'The Minecraft process is already stopped.'
+        process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._waiter_task), grace)
+        except asyncio.TimeoutError:
+            process.kill()
+            await self._waiter_task
+        return True, process.returncode
+
+    async def supervisor_stats(self):
+        if self._supervisor is None:
+            return False, 'Not supervised. Start with --supervise.'
+        return True, self._supervisor.stats()
 
     async def wait(self):
         await self._process.wait()
 
     async def stop(self):
-        async with self._command_lock:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        async with self._locked('stop'):
             if self._process is None:
                 return False, 'The Minecraft process is already stopped.'
-            await self._comms.send_command("stop")
+            if self._comms is not None and not self._comms.connected:
+                await self._comms.close()
+                self._comms = None
+            if self._comms is None:
+                await self._reconnect(time.monotonic() + self._rcon_timeout)
+            if self._comms is None:
+                return False, 'RCON is not connected, so the server can\'t be asked to stop.'
+            self._stopping = True
+            try:
+                await self._comms.send_command("stop")
+            except (asyncio.TimeoutError, OSError) as ex:
+                # Hung or unreachable. Its exit isn't a clean stop, so the
+                # supervisor records it as what it was, but it isn't brought
+                # back either: somebody asked for it to stop.
+                self._stopping = False
+                await self._comms.close()
+                self._comms = None
+                await self.kill()
+                if self._supervisor is not None:
+                    self._supervisor.cancel()
+                return False, 'The server didn\'t take the stop command ({!r}), so it was killed.'.format(ex)
             await self._comms.close() # Some versions of minecraft hang if RCON is connected when stopped.
             self._comms = None
             await self.wait()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import struct
+
+class RegionFile:
+    class RegionFileError(Exception): pass
+
+    SECTOR_SIZE = 4096
+    CHUNK_COUNT = 1024
+    # 1024 big-endian (offset << 8 | sector count) locations, then 1024 timestamps.
+    HEADER = struct.Struct(">1024I1024I")
+    LENGTH = struct.Struct(">I")
+
+    def __init__(self, f):
+        self._f = f
+        self._f.seek(0, 2)
+        self._file_size = self._f.tell()
+        if self._file_size < self.HEADER.size:
+            raise self.__class__.RegionFileError("Too small to be a region file.")
+        self._f.seek(0)
+        header = self.HEADER.unpack(self._f.read(self.HEADER.size))
+        self.locations = [(x >> 8, x & 0xff) for x in header[:self.CHUNK_COUNT]]
+        self.timestamps = list(header[self.CHUNK_COUNT:])
+
+    def present(self):
+        return [i for i, (offset, count) in enumerate(self.locations) if offset != 0 and count != 0]
+
+    def read_chunk(self, index):
+        # Returns the chunk exactly as stored: length prefix, compression type
+        # and compressed data, without the sector padding.
+        offset, count = self.locations[index]
+        start = offset * self.SECTOR_SIZE
+        if offset < 2 or start + self.LENGTH.size > self._file_size:
+            raise self.__class__.RegionFileError("Chunk {} is outside of the file.".format(index))
+        self._f.seek(start)
+        length = self.LENGTH.unpack(self._f.read(self.LENGTH.size))[0]
+        if length == 0 or length + self.LENGTH.size > count * self.SECTOR_SIZE:
+            raise self.__class__.RegionFileError("Chunk {} has a bad length ({}).".format(index, length))
+        data = self._f.read(length)
+        if len(data) != length:
+            raise self.__class__.RegionFileError("Chunk {} is truncated.".format(index))
+        return self.LENGTH.pack(length) + data
+
+    @classmethod
+    def write(cls, f, timestamps, chunks):
+        # chunks maps index -> bytes as returned by read_chunk. Chunks are laid
+        # out back to back after the header in index order.
+        locations = [0] * cls.CHUNK_COUNT
+        sector = cls.HEADER.size // cls.SECTOR_SIZE
+        for index in sorted(chunks):
+            count = -(-len(chunks[index]) // cls.SECTOR_SIZE)
+            if count > 0xff:
+                raise cls.RegionFileError("Chunk {} is too large for a region file.".format(index))
+            locations[index] = sector << 8 | count
+            sector += count
+        f.write(cls.HEADER.pack(*locations, *timestamps))
+        for index in sorted(chunks):
+            data = chunks[index]
+            f.write(data)
+            padding = -len(data) % cls.SECTOR_SIZE
+            if padding:
+                f.write(bytes(padding))
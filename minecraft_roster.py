@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import os
+import json
+
+class RosterFile:
+    # One of the server's JSON list files, indexed by lower-cased name and by
+    # UUID. The file is stat()ed on every query and only re-read when that
+    # changes, which costs far less than an RCON round trip and works with
+    # the server down.
+    def __init__(self, filename):
+        self._filename = filename
+        self._stat = None
+        self._by_name = {}
+        self._by_uuid = {}
+        # Set once the file has been read (or found missing) at least once.
+        self.loaded = False
+
+    def _refresh(self):
+        try:
+            st = os.stat(self._filename)
+        except FileNotFoundError:
+            # The server creates these on first start. Until then they're empty.
+            self._stat, self._by_name, self._by_uuid, self.loaded = None, {}, {}, True
+            return
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat == self._stat:
+            return
+        try:
+            with open(self._filename, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            if not isinstance(entries, list):
+                raise ValueError("{} isn't a list.".format(self._filename))
+        except (OSError, ValueError):
+            # Probably caught the server halfway through writing it. Keep what
+            # we had and try again next time.
+            return
+        self._by_name = {x['name'].lower(): x for x in entries if isinstance(x, dict) and isinstance(x.get('name'), str)}
+        self._by_uuid = {x['uuid'].lower(): x for x in entries if isinstance(x, dict) and isinstance(x.get('uuid'), str)}
+        self._stat = stat
+        self.loaded = True
+
+    def by_name(self, name):
+        self._refresh()
+        return self._by_name.get(name.lower())
+
+    def by_uuid(self, uuid):
+        self._refresh()
+        return self._by_uuid.get(uuid.lower())
+
+    def names(self):
+        # Set-like view of the lower-cased names, or None if the file has
+        # never been readable.
+        self._refresh()
+        return self._by_name.keys() if self.loaded else None
+
+    def entries(self):
+        self._refresh()
+        return list(self._by_name.values()) if self.loaded else None
+
+class RosterIndex:
+    files = {
+        'whitelist': "whitelist.json",
+        'banlist': "banned-players.json",
+        'ops': "ops.json",
+        'usercache': "usercache.json",
+        }
+
+    def __init__(self, world_path):
+        self._rosters = {roster: RosterFile(os.path.join(world_path, filename)) for roster, filename in self.files.items()}
+
+    def __getitem__(self, roster):
+        return self._rosters[roster]
+
+    def _find(self, player):
+        # Accepts a name or a UUID; usercache.json knows every player who has
+        # ever joined, the rosters cover players added before joining.
+        lookup = 'by_uuid' if len(player) == 36 and player.count('-') == 4 else 'by_name'
+        for roster in ('usercache', 'whitelist', 'ops', 'banlist'):
+            entry = getattr(self._rosters[roster], lookup)(player)
+            if entry is not None:
+                return entry.get('name', player), entry.get('uuid')
+        return (player, None) if lookup == 'by_name' else (None, player)
+
+    def player(self, player):
+        name, uuid = self._find(player)
+        info = {'name': name, 'uuid': uuid}
+        for roster in ('whitelist', 'ops', 'banlist'):
+            roster_file = self._rosters[roster]
+            entry = roster_file.by_uuid(uuid) if uuid is not None else None
+            if entry is None and name is not None:
+                entry = roster_file.by_name(name)
+            info[roster] = entry
+        return info
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import array
+import math
+import re
+
+# Everything is stored as doubles, with NaN for "not sampled".
+NAN = float('nan')
+
+METRICS = ('tps', 'mspt', 'players', 'entities', 'chunks', 'heap_used', 'heap_committed', 'gc_ms', 'gc_count')
+
+# (name, bucket size in seconds, buckets kept): an hour of seconds, a day of
+# minutes and a month of hours.
+RESOLUTIONS = (('1s', 1, 3600), ('1min', 60, 1440), ('1h', 3600, 744))
+
+PERCENTILES = (50, 90, 99)
+
+class Ring:
+    # Fixed-size ring of doubles. Allocated up front, so memory use doesn't
+    # change however long the server stays up.
+    def __init__(self, capacity):
+        self._values = array.array('d', [NAN]) * capacity
+        self._capacity = capacity
+        self._next = 0
+        self.count = 0
+
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self._capacity
+        self.count = min(self.count + 1, self._capacity)
+
+    def values(self):
+        # Oldest first.
+        start = (self._next - self.count) % self._capacity
+        if start + self.count <= self._capacity:
+            return self._values[start:start + self.count].tolist()
+        return (self._values[start:] + self._values[:self._next]).tolist()
+
+class Rollup:
+    # One resolution: a ring of bucket start times and, per metric, rings of
+    # the mean and max of the samples that fell in each bucket.
+    def __init__(self, step, capacity, metrics=METRICS):
+        self.step = step
+        self._metrics = metrics
+        self._times = Ring(capacity)
+        self._means = {x: Ring(capacity) for x in metrics}
+        self._maxes = {x: Ring(capacity) for x in metrics}
+        self._bucket = None
+        self._sums = dict.fromkeys(metrics, 0.0)
+        self._counts = dict.fromkeys(metrics, 0)
+        self._peaks = dict.fromkeys(metrics, NAN)
+
+    def _open_bucket(self):
+        # (time, {metric: (mean, max)}) for the bucket still being filled.
+        return self._bucket * self.step, {
+            x: (self._sums[x] / self._counts[x], self._peaks[x]) if self._counts[x] else (NAN, NAN) for x in self._metrics}
+
+    def _flush(self):
+        bucket_time, values = self._open_bucket()
+        self._times.append(bucket_time)
+        for metric, (mean, peak) in values.items():
+            self._means[metric].append(mean)
+            self._maxes[metric].append(peak)
+            self._sums[metric], self._counts[metric], self._peaks[metric] = 0.0, 0, NAN
+
+    def add(self, t, sample):
+        bucket = int(t // self.step)
+        if self._bucket is not None and bucket != self._bucket:
+            self._flush()
+        self._bucket = bucket
+        for metric, value in sample.items():
+            if value is None or math.isnan(value):
+                continue
+            self._sums[metric] += value
+            self._counts[metric] += 1
+            # max() with NaN first returns NaN, so compare the other way round.
+            self._peaks[metric] = value if math.isnan(self._peaks[metric]) else max(self._peaks[metric], value)
+
+    def series(self):
+        times = self._times.values()
+        means = {x: self._means[x].values() for x in self._metrics}
+        maxes = {x: self._maxes[x].values() for x in self._metrics}
+        if self._bucket is not None:
+            bucket_time, values = self._open_bucket()
+            times.append(bucket_time)
+            for metric, (mean, peak) in values.items():
+                means[metric].append(mean)
+                maxes[metric].append(peak)
+        return times, means, maxes
+
+def _json_value(value):
+    return None if math.isnan(value) else round(value, 3)
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list.
+    return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+
+class PerfStats:
+    # Server performance samples at three resolutions. Feeding a sample
+    # touches a handful of preallocated arrays; summaries are only worked out
+    # when somebody asks.
+    def __init__(self, metrics=METRICS, resolutions=RESOLUTIONS):
+        self._metrics = metrics
+        self._rollups = {name: Rollup(step, capacity, metrics) for name, step, capacity in resolutions}
+        self.latest = None
+        self.samples = 0
+
+    def add(self, t, sample):
+        for rollup in self._rollups.values():
+            rollup.add(t, sample)
+        self.latest = dict(sample, time=t)
+        self.samples += 1
+
+    def summary(self, resolution=None, series=False):
+        # Percentiles of the bucket means (and the highest bucket max) for
+        # each metric at each resolution, plus the raw series for one
+        # resolution if asked for.
+        if resolution is not None and resolution not in self._rollups:
+            raise ValueError("resolution must be one of {}".format(', '.join(self._rollups)))
+        result = {
+            'samples': self.samples,
+            'latest': None if self.latest is None else {x: _json_value(y) if isinstance(y, float) else y for x, y in self.latest.items()},
+            'resolutions': {},
+            }
+        for name, rollup in self._rollups.items():
+            if resolution is not None and name != resolution:
+                continue
+            times, means, maxes = rollup.series()
+            summary = {'step': rollup.step, 'buckets': len(times), 'percentiles': {}}
+            for metric in self._metrics:
+                ordered = sorted(x for x in means[metric] if not math.isnan(x))
+                if not ordered:
+                    continue
+                summary['percentiles'][metric] = {'p{}'.format(p): _json_value(percentile(ordered, p)) for p in PERCENTILES}
+                summary['percentiles'][metric]['max'] = _json_value(max(x for x in maxes[metric] if not math.isnan(x)))
+            if series:
+                summary['time'] = [int(x) for x in times]
+                summary['mean'] = {x: [_json_value(y) for y in means[x]] for x in self._metrics}
+                summary['max'] = {x: [_json_value(y) for y in maxes[x]] for x in self._metrics}
+            result['resolutions'][name] = summary
+        return result
+
+PERF_COUNTER_RE = re.compile(r'^(sun\.[\w.]+)=(\d+)$', re.MULTILINE)
+HEAP_USED_RE = re.compile(r'^sun\.gc\.generation\.\d+\.space\.\d+\.used$')
+HEAP_COMMITTED_RE = re.compile(r'^sun\.gc\.generation\.\d+\.capacity$')
+GC_COUNT_RE = re.compile(r'^sun\.gc\.collector\.\d+\.invocations$')
+GC_TIME_RE = re.compile(r'^sun\.gc\.collector\.\d+\.time$')
+
+def parse_perf_counters(output):
+    # `jcmd <pid> PerfCounter.print` lists the JVM's counters as name=value,
+    # sizes in bytes and times in ticks of sun.os.hrt.frequency. Returns heap
+    # sizes in MiB and the cumulative GC count and time (seconds), or None if
+    # the output isn't recognised. Collectors that don't report a heap figure
+    # leave it out.
+    counters = {name: int(value) for name, value in PERF_COUNTER_RE.findall(output)}
+    frequency = counters.get('sun.os.hrt.frequency')
+    gc_times = [value for name, value in counters.items() if GC_TIME_RE.match(name)]
+    if not frequency or not gc_times:
+        return None
+    result = {
+        'gc_count': float(sum(value for name, value in counters.items() if GC_COUNT_RE.match(name))),
+        'gc_time': sum(gc_times) / frequency,
+        }
+    for key, name_re in (('heap_used', HEAP_USED_RE), ('heap_committed', HEAP_COMMITTED_RE)):
+        values = [value for name, value in counters.items() if name_re.match(name)]
+        if values:
+            result[key] = sum(values) / (1 << 20)
+    return result
+
+# "There are 3 of a max of 20 players online: ..." (vanilla, Spigot and Paper.)
+PLAYERS_RE = re.compile(r'There (?:are|is) (\d+)')
+# "Test passed, count: 123" from `execute if entity @e`, or "Test failed"
+# when there are none.
+ENTITIES_RE = re.compile(r'Test passed, count: (\d+)|Test failed()')
+# Paper's `paper chunkinfo *` prints a "Total: n" per world.
+CHUNKS_RE = re.compile(r'Total: (\d+)')
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+
+class Supervisor:
+    # Keeps a MinecraftProcess up. Unexpected exits are restarted after a
+    # delay that doubles with each recent crash, until crash_loop_limit
+    # crashes within crash_loop_window, at which point it gives up until
+    # somebody starts the server by hand.
+    #
+    # A server that's running but not ticking is caught with a heartbeat:
+    # RCON commands run on the main thread, so one that takes longer than
+    # heartbeat_timeout (or a "Can't keep up" of stall_ms or more) is a
+    # miss, and hang_after misses in a row get the server thread dumped and
+    # killed, after which it's restarted like any other crash.
+    def __init__(self, mc_process, *, heartbeat_interval=15.0, heartbeat_timeout=10.0, hang_after=4, stall_ms=30000,
+                 restart_delay=5.0, restart_max_delay=300.0, crash_loop_limit=5, crash_loop_window=900.0):
+        self._mc = mc_process
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_timeout = heartbeat_timeout
+        self._hang_after = hang_after
+        self._stall_ms = stall_ms
+        self._restart_delay = restart_delay
+        self._restart_max_delay = restart_max_delay
+        self._crash_loop_limit = crash_loop_limit
+        self._crash_loop_window = crash_loop_window
+        self._heartbeat_task = None
+        self._restart_task = None
+        # Set while _restart() is the one starting the server.
+        self._restarting = False
+        self._crash_times = []
+        self._misses = 0
+        self._stalled = False
+        self._hung = False
+        self._up_since = None
+        self._down_since = None
+        self.state = 'stopped'
+        self.counts = {'restarts': 0, 'crashes': 0, 'hangs': 0}
+        self.downtime_seconds = 0.0
+        self.last_exit = None
+        self.last_latency = None
+        self.last_thread_dump = None
+
+    def process_started(self):
+        now = time.monotonic()
+        if self._down_since is not None:
+            self.downtime_seconds += now - self._down_since
+            self._down_since = None
+        self._up_since = now
+        if not self._restarting:
+            # Started by hand, after a crash loop or otherwise: start counting
+            # crashes afresh.
+            self._crash_times = []
+        self._misses = 0
+        self._stalled = False
+        self._hung = False
+        self.state = 'running'
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+
+    def process_exited(self, returncode, expected):
+        self._up_since = None
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        reason = 'stop' if expected else 'hang' if self._hung else 'crash'
+        self.last_exit = {'time': time.time(), 'returncode': returncode, 'reason': reason}
+        if expected:
+            self.state = 'stopped'
+            return
+        self.counts['crashes'] += 1
+        self._crash_times.append(time.monotonic())
+        if self._down_since is None:
+            self._down_since = time.monotonic()
+        # A restart already underway notices the failure itself.
+        if self._restart_task is None:
+            self._restart_task = asyncio.ensure_future(self._restart())
+
+    def tick_stalled(self, event):
+        # Handler for lag events.
+        if int(event['ms']) >= self._stall_ms:
+            self._stalled = True
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            start_time = time.monotonic()
+            try:
+                success, response = await self._mc.heartbeat(self._heartbeat_timeout)
+            except Exception:
+                # A lost connection and the like: whatever it was, the server
+                # didn't answer.
+                success = False
+            self.last_latency = time.monotonic() - start_time
+            if success and not self._stalled:
+                self._misses = 0
+                continue
+            self._stalled = False
+            self._misses += 1
+            if self._misses >= self._hang_after:
+                break
+        # Not cancellable from here on: process_exited() would otherwise
+        # cancel the kill it's being told about.
+        self._heartbeat_task = None
+        await self._handle_hang()
+
+    async def _handle_hang(self):
+        self._hung = True
+        self.counts['hangs'] += 1
+        self.state = 'hung'
+        self.last_thread_dump = await self._mc.thread_dump()
+        await self._mc.kill()
+
+    async def _restart(self):
+        try:
+            while True:
+                now = time.monotonic()
+                self._crash_times = [x for x in self._crash_times if now - x < self._crash_loop_window]
+                if len(self._crash_times) >= self._crash_loop_limit:
+                    self.state = 'crash_loop'
+                    return
+                self.state = 'restarting'
+                await asyncio.sleep(min(self._restart_max_delay, self._restart_delay * 2 ** (len(self._crash_times) - 1)))
+                if (await self._mc.query())[0]:
+                    # Somebody started it by hand in the meantime.
+                    return
+                crashes = self.counts['crashes']
+                self._restarting = True
+                try:
+                    result = await self._mc.start()
+                finally:
+                    self._restarting = False
+                if result[0]:
+                    self.counts['restarts'] += 1
+                    return
+                if (await self._mc.query())[0]:
+                    # Up, but without RCON. No good to anybody.
+                    await self._mc.kill()
+                if self.counts['crashes'] == crashes:
+                    # Never got as far as a process to exit.
+                    self.counts['crashes'] += 1
+                    self._crash_times.append(time.monotonic())
+        finally:
+            self._restart_task = None
+
+    def cancel(self):
+        # Somebody stopped the server on purpose; don't bring it back.
+        if self._restart_task is not None:
+            self._restart_task.cancel()
+        if self._down_since is not None:
+            self.downtime_seconds += time.monotonic() - self._down_since
+            self._down_since = None
+        self.state = 'stopped'
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'state': self.state,
+            **self.counts,
+            'downtime_seconds': round(self.downtime_seconds + (now - self._down_since if self._down_since is not None else 0.0), 3),
+            'uptime_seconds': round(now - self._up_since, 3) if self._up_since is not None else None,
+            'recent_crashes': len([x for x in self._crash_times if now - x < self._crash_loop_window]),
+            'last_exit': self.last_exit,
+            'heartbeat_latency': round(self.last_latency, 3) if self.last_latency is not None else None,
+            'heartbeat_misses': self._misses,
+            'last_thread_dump': self.last_thread_dump,
+            }
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import signal
+import time
+import collections
+
+class BackupThrottle:
+    # Duty-cycles a backup's process group against server tick health. Every
+    # period the group runs for duty * period seconds and is stopped for the
+    # rest. Duty is halved while ticks are degraded and creeps back up while
+    # they're healthy, so the backup goes flat out on an idle server and
+    # backs off quickly when players start to feel it.
+    def __init__(self, sample, *, target_mspt=45.0, min_tps=19.5, period=1.0, sample_interval=2.0, min_duty=0.1, max_decisions=100):
+        self._sample = sample
+        self._target_mspt = target_mspt
+        self._min_tps = min_tps
+        self._period = period
+        self._sample_interval = sample_interval
+        self._min_duty = min_duty
+        self._duty = 1.0
+        self._pgid = None
+        self._tasks = []
+        self._started = None
+        self._paused_seconds = 0.0
+        self._samples = 0
+        self._lowest_duty = 1.0
+        self._decisions = collections.deque(maxlen=max_decisions)
+
+    def _signal(self, signum):
+        try:
+            os.killpg(self._pgid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _decide(self, health):
+        # Returns the new duty for a sample, or None to leave it alone.
+        mspt, tps = health.get('mspt'), health.get('tps')
+        degraded = (mspt is not None and mspt > self._target_mspt) or (tps is not None and tps < self._min_tps)
+        if degraded:
+            return max(self._min_duty, self._duty / 2)
+        healthy = mspt < self._target_mspt * 0.6 if mspt is not None else tps is not None and tps >= 19.9
+        if healthy and self._duty < 1.0:
+            return min(1.0, self._duty + 0.1)
+        return None
+
+    async def _sampler(self):
+        while True:
+            health = await self._sample()
+            if health is not None:
+                self._samples += 1
+                duty = self._decide(health)
+                if duty is not None and duty != self._duty:
+                    self._duty = duty
+                    self._lowest_duty = min(self._lowest_duty, duty)
+                    self._decisions.append({'t': round(time.monotonic() - self._started, 3), 'duty': round(duty, 3), **health})
+            await asyncio.sleep(self._sample_interval)
+
+    async def _pacer(self):
+        while True:
+            if self._duty >= 1.0:
+                await asyncio.sleep(self._period)
+                continue
+            await asyncio.sleep(self._period * self._duty)
+            pause = self._period * (1.0 - self._duty)
+            self._signal(signal.SIGSTOP)
+            try:
+                await asyncio.sleep(pause)
+            finally:
+                self._signal(signal.SIGCONT)
+            self._paused_seconds += pause
+
+    def start(self, pgid):
+        self._pgid = pgid
+        self._started = time.monotonic()
+        self._tasks = [asyncio.ensure_future(self._sampler()), asyncio.ensure_future(self._pacer())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._signal(signal.SIGCONT)
+        return {
+            'samples': self._samples,
+            'paused_seconds': round(self._paused_seconds, 3),
+            'final_duty': round(self._duty, 3),
+            'lowest_duty': round(self._lowest_duty, 3),
+            'decisions': list(self._decisions),
+            }
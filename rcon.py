@@ -2,6 +2,8 @@
 import asyncio
 import struct
 import random
+import time
+import contextlib
 from collections import namedtuple
 
 class RCONMessage:
@@ -53,6 +55,11 @@ class RCONMessage:
         self._payload = value
         self._size = self.PREFIX.size + self.SUFFIX.size + len(value)
         
+    @property
+    def wire_size(self):
+        # Bytes on the wire, including the length prefix.
+        return self.SIZE.size + self._size
+
     @property
     def request_id(self):
         return self._request_id
@@ -89,19 +96,80 @@ class RCONMessage:
 
 class RCON:
     SendAndReceive = namedtuple("SendAndReceive", ('send_msg', 'recv_msg'))
+    # Servers answer requests of an unknown type with a single packet, and
+    # answer in order, so one of these sent after a command marks the end of
+    # that command's (possibly fragmented) response.
+    SENTINEL_TYPE = 0
 
-    def __init__(self, addr, port):
+    def __init__(self, addr, port, *, timeout=None, observer=None):
         self._addr = addr
         self._port = int(port)
+        self._timeout = timeout
+        # observer(seconds, bytes_sent, bytes_received, timed_out) is called
+        # after every request, for metrics.
+        self._observer = observer
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        # The server reads each client one packet per read() and drops the
+        # connection if a read holds more than one, so only one request is
+        # ever outstanding. Concurrency comes from more connections.
+        self._request_lock = asyncio.Lock()
+        # request_id -> Future waiting for the reply with that id, or Queue
+        # collecting every fragment sent with that id. Insertion order doubles
+        # as send order, which is what the server answers in.
+        self._pending = {}
+        # sentinel request_id -> request_id of the stream it terminates
+        self._sentinels = {}
         
     async def connect(self):
         self._reader, self._writer = await asyncio.open_connection(self._addr, self._port)
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    @property
+    def connected(self):
+        # False once the connection has dropped or been closed.
+        return self._reader_task is not None
         
     async def recv_msg(self):
         raw_data = await self._reader.readexactly(RCONMessage.SIZE.size)
         size = RCONMessage.SIZE.unpack(raw_data)[0]
         raw_data += await self._reader.readexactly(size)
         return RCONMessage(raw_data)
+
+    def _route_msg(self, msg):
+        stream_id = self._sentinels.pop(msg.request_id, None)
+        if stream_id is not None:
+            stream = self._pending.pop(stream_id, None)
+            if stream is not None:
+                stream.put_nowait(None)
+            return
+        if isinstance(self._pending.get(msg.request_id), asyncio.Queue):
+            self._pending[msg.request_id].put_nowait(msg)
+            return
+        future = self._pending.pop(msg.request_id, None)
+        if future is None and msg.request_id == 0xffffffff and self._pending:
+            # Failed auth is answered with request id -1 instead of the one we sent.
+            future = self._pending.pop(next(iter(self._pending)))
+        if future is not None and not future.done():
+            future.set_result(msg)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._route_msg(await self.recv_msg())
+        except asyncio.CancelledError:
+            error = ConnectionError("RCON connection closed.")
+        except Exception as ex:
+            error = ConnectionError("RCON connection lost: {!r}".format(ex))
+        for future in self._pending.values():
+            if isinstance(future, asyncio.Queue):
+                future.put_nowait(error)
+            elif not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        self._sentinels.clear()
+        self._reader_task = None
     
     async def send_msg(self, *args):
         if len(args) == 1 and isinstance(args[0], RCONMessage):
@@ -114,12 +182,87 @@ class RCON:
         await self._writer.drain()
         return msg
         
-    async def send_and_recv(self, *args):
-        send_msg = await self.send_msg(*args)
-        recv_msg = await self.recv_msg()
+    async def send_and_recv(self, *args, timeout=None):
+        if self._reader_task is None:
+            raise ConnectionError("RCON is not connected.")
+        if len(args) == 1 and isinstance(args[0], RCONMessage):
+            send_msg = args[0]
+        else:
+            send_msg = RCONMessage(*args)
+        async with self._request_lock:
+            if self._reader_task is None:
+                raise ConnectionError("RCON is not connected.")
+            future = asyncio.get_running_loop().create_future()
+            self._pending[send_msg.request_id] = future
+            start_time = time.monotonic()
+            recv_msg = None
+            try:
+                await self.send_msg(send_msg)
+                recv_msg = await asyncio.wait_for(future, timeout if timeout is not None else self._timeout)
+            except asyncio.TimeoutError:
+                if self._observer is not None:
+                    self._observer(time.monotonic() - start_time, send_msg.wire_size, 0, True)
+                raise
+            finally:
+                self._pending.pop(send_msg.request_id, None)
+        if self._observer is not None:
+            self._observer(time.monotonic() - start_time, send_msg.wire_size, recv_msg.wire_size, False)
         return self.SendAndReceive(send_msg, recv_msg)
+
+    async def send_and_stream(self, *args, timeout=None):
+        # Async iterator over every reply packet to one request. The timeout
+        # applies to the wait for each packet rather than the whole response.
+        if self._reader_task is None:
+            raise ConnectionError("RCON is not connected.")
+        if len(args) == 1 and isinstance(args[0], RCONMessage):
+            send_msg = args[0]
+        else:
+            send_msg = RCONMessage(*args)
+        sentinel_msg = RCONMessage(self.SENTINEL_TYPE, b'')
+        stream = asyncio.Queue()
+        if timeout is None:
+            timeout = self._timeout
+        await self._request_lock.acquire()
+        if self._reader_task is None:
+            self._request_lock.release()
+            raise ConnectionError("RCON is not connected.")
+        self._pending[send_msg.request_id] = stream
+        self._sentinels[sentinel_msg.request_id] = send_msg.request_id
+        start_time = time.monotonic()
+        sent = 0
+        received = 0
+        try:
+            await self.send_msg(send_msg)
+            sent += send_msg.wire_size
+            while True:
+                try:
+                    recv_msg = await asyncio.wait_for(stream.get(), timeout)
+                except asyncio.TimeoutError:
+                    if self._observer is not None:
+                        self._observer(time.monotonic() - start_time, sent, received, True)
+                    raise
+                if recv_msg is None:
+                    break
+                if isinstance(recv_msg, Exception):
+                    raise recv_msg
+                if sent == send_msg.wire_size:
+                    # Only once the reply has started: by then the server has
+                    # read the command, so the sentinel gets a read() of its
+                    # own instead of arriving stuck to the command.
+                    await self.send_msg(sentinel_msg)
+                    sent += sentinel_msg.wire_size
+                received += recv_msg.wire_size
+                yield recv_msg
+            if self._observer is not None:
+                self._observer(time.monotonic() - start_time, sent, received, False)
+        finally:
+            self._pending.pop(send_msg.request_id, None)
+            self._sentinels.pop(sentinel_msg.request_id, None)
+            self._request_lock.release()
         
     async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
         self._writer.close()
         if(hasattr(self._writer, 'wait_closed')):
             await self._writer.wait_closed()
@@ -127,8 +270,8 @@ class RCON:
 class MinecraftRCON(RCON):
     class MinecraftRCONError(Exception): pass
     
-    def __init__(self, addr, port):
-        super().__init__(addr, port)
+    def __init__(self, addr, port, *, timeout=None, observer=None):
+        super().__init__(addr, port, timeout=timeout, observer=observer)
         
     async def send_password(self, password):
         if isinstance(password, str):
@@ -137,17 +280,146 @@ class MinecraftRCON(RCON):
             raise TypeError("Password must be bytes or str")
 
         send_msg, recv_msg = await self.send_and_recv(3, password)
-        if recv_msg.type == 0xffffffff:
+        if recv_msg.type == 0xffffffff or recv_msg.request_id == 0xffffffff:
             return False
         if recv_msg.request_id == send_msg.request_id:
             return True
         raise self.__class__.MinecraftRCONError("Minecraft auth neither failed nor succeeded: {!s}".format(recv_msg))
         
-    async def send_command(self, *cmd):
+    @staticmethod
+    def _encode_command(cmd):
         cmd = [x.encode('utf-8') if isinstance(x, str) else x for x in cmd]
-        cmd = b' '.join(cmd)
-        return (await self.send_and_recv(2, cmd)).recv_msg
-        
+        return b' '.join(cmd)
+
+    async def send_command(self, *cmd, timeout=None, multipacket=False):
+        if not multipacket:
+            return (await self.send_and_recv(2, self._encode_command(cmd), timeout=timeout)).recv_msg
+        payload = bytearray()
+        recv_msg = None
+        async for recv_msg in self.send_and_stream(2, self._encode_command(cmd), timeout=timeout):
+            payload += recv_msg.payload
+        if recv_msg is None:
+            raise self.__class__.MinecraftRCONError("No response to {!r}".format(cmd))
+        return RCONMessage(recv_msg.type, bytes(payload), recv_msg.request_id)
+
+    async def stream_command(self, *cmd, timeout=None):
+        # Yields the response payload fragment by fragment. Fragments can split
+        # multi-byte characters, so decode with an incremental decoder.
+        async for recv_msg in self.send_and_stream(2, self._encode_command(cmd), timeout=timeout):
+            yield recv_msg.payload
+
+class MinecraftRCONPool:
+    # Up to size authenticated MinecraftRCON connections, each carrying one
+    # request at a time. The first is opened by connect(); the rest as load
+    # needs them. Connections that drop are thrown away, and once none are
+    # left connected is False and the owner should make a new pool.
+    def __init__(self, addr, port, password, *, size=4, timeout=None, observer=None):
+        self._addr = addr
+        self._port = port
+        self._password = password
+        self._size = size
+        self._timeout = timeout
+        self._observer = observer
+        self._idle = []
+        # Connections open or opening, idle or not.
+        self._count = 0
+        self._open_connections = set()
+        self._released = asyncio.Condition()
+        self._closed = False
+
+    async def _open(self):
+        rcon = MinecraftRCON(self._addr, self._port, timeout=self._timeout, observer=self._observer)
+        await rcon.connect()
+        try:
+            if not await rcon.send_password(self._password):
+                raise MinecraftRCON.MinecraftRCONError("RCON password rejected.")
+        except BaseException:
+            await rcon.close()
+            raise
+        return rcon
+
+    async def connect(self):
+        # Returns whether the password was accepted. Fails with OSError if
+        # the server isn't listening.
+        self._count += 1
+        try:
+            rcon = await self._open()
+        except MinecraftRCON.MinecraftRCONError:
+            self._count -= 1
+            return False
+        except BaseException:
+            self._count -= 1
+            raise
+        self._open_connections.add(rcon)
+        self._idle.append(rcon)
+        return True
+
+    @property
+    def connected(self):
+        return not self._closed and any(x.connected for x in self._open_connections)
+
+    async def _discard(self, rcon):
+        self._open_connections.discard(rcon)
+        self._count -= 1
+        try:
+            await rcon.close()
+        except OSError:
+            pass
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        rcon = None
+        while rcon is None:
+            if self._closed:
+                raise ConnectionError("RCON is not connected.")
+            if self._idle:
+                rcon = self._idle.pop()
+                if not rcon.connected:
+                    await self._discard(rcon)
+                    rcon = None
+            elif self._count < self._size:
+                self._count += 1
+                try:
+                    rcon = await self._open()
+                except (OSError, MinecraftRCON.MinecraftRCONError):
+                    self._count -= 1
+                    if not self._open_connections:
+                        raise ConnectionError("RCON is not connected.")
+                    # Make do with the ones already open, which are all busy.
+                    async with self._released:
+                        await self._released.wait()
+                    continue
+                self._open_connections.add(rcon)
+            else:
+                async with self._released:
+                    await self._released.wait()
+        try:
+            yield rcon
+        finally:
+            if rcon.connected and not self._closed:
+                self._idle.append(rcon)
+            else:
+                await self._discard(rcon)
+            async with self._released:
+                self._released.notify()
+
+    async def send_command(self, *cmd, timeout=None, multipacket=False):
+        async with self._connection() as rcon:
+            return await rcon.send_command(*cmd, timeout=timeout, multipacket=multipacket)
+
+    async def stream_command(self, *cmd, timeout=None):
+        async with self._connection() as rcon:
+            async for payload in rcon.stream_command(*cmd, timeout=timeout):
+                yield payload
+
+    async def close(self):
+        self._closed = True
+        connections, self._open_connections, self._idle = list(self._open_connections), set(), []
+        await asyncio.gather(*[x.close() for x in connections], return_exceptions=True)
+        async with self._released:
+            self._released.notify_all()
+
+
 async def module_main(server, port, password, command):
     mcrcon = MinecraftRCON(server, port)
     